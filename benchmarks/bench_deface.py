@@ -0,0 +1,139 @@
+"""Benchmark of the built-in defacer on a synthetic head phantom.
+
+Compares the built-in defacer (pseudicom._deface) with BET + Quickshear in
+speed, and in the overlap of the brain masks and of the defaced volumes (the
+voxels that are kept). Without FSL, the built-in shear plane is compared with
+that of Quickshear on the same (built-in) brain mask only.
+
+The phantom is an ellipsoid brain (white and grey matter, ventricles) within
+CSF, skull and scalp, with a brain stem reaching down into the neck, and a
+face (jaw and nose) in front of it.
+
+Expected: a brain mask Dice of at least 0.95 with the ground truth, and an
+identical shear plane to Quickshear on the same mask (Dice 1.0 of the kept
+voxels); with FSL, a Dice of the kept voxels of at least 0.98.
+
+Usage: python benchmarks/bench_deface.py [voxel_size]
+
+"""
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nb
+from quickshear import quickshear
+
+from pseudicom._deface import brain_mask, deface
+
+
+def _ellipsoid(grid, center, radii):
+    return sum(((g - c) / r) ** 2 for g, c, r in zip(grid, center, radii)) \
+        <= 1
+
+
+def _cylinder(grid, center, radius, z_range):
+    x, y, z = grid
+    return ((x - center[0]) ** 2 + (y - center[1]) ** 2 <= radius ** 2) & \
+        (z >= z_range[0]) & (z <= z_range[1])
+
+
+def make_phantom(voxel_size=1.0, seed=0):
+    """Make a T1-weighted head phantom (RAS orientation).
+
+    Returns the image and the ground truth brain mask.
+
+    """
+
+    shape = tuple(int(round(x / voxel_size)) for x in (144, 176, 160))
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    grid = [g * voxel_size for g in grid]  # in mm
+    center = (72, 88, 95)
+    brain = (55, 70, 50)
+
+    data = np.zeros(shape, dtype=np.float32)
+    neck = _cylinder(grid, (72, 80), 40, (0, 60))
+    data[neck] = 60
+    data[_ellipsoid(grid, (72, 125, 35), (45, 40, 30))] = 60  # jaw
+    data[_ellipsoid(grid, center, [r + 13 for r in brain])] = 70  # scalp
+    data[_ellipsoid(grid, (72, 166, 65), (10, 12, 15))] = 70  # nose
+    data[_ellipsoid(grid, center, [r + 9 for r in brain])] = 5  # skull
+    data[_ellipsoid(grid, center, [r + 3 for r in brain])] = 20  # CSF
+    data[_cylinder(grid, (72, 75), 16, (20, 50))] = 20
+    truth = _ellipsoid(grid, center, brain)
+    data[truth] = 80  # grey matter
+    data[_ellipsoid(grid, center, [r - 4 for r in brain])] = 100
+    data[_ellipsoid(grid, center, (8, 20, 12))] = 20  # ventricles
+    stem = _cylinder(grid, (72, 75), 10, (20, center[2]))
+    data[stem & ~truth] = 90
+    truth = truth | (stem & (grid[2] >= 50))
+    data += np.random.default_rng(seed).normal(0, 3, shape)
+    data = np.clip(data, 0, None).astype(np.int16)
+    affine = np.diag([voxel_size] * 3 + [1.0])
+    return nb.Nifti1Image(data, affine), truth
+
+
+def dice(a, b):
+    return 2 * np.count_nonzero(a & b) / (np.count_nonzero(a) +
+                                         np.count_nonzero(b))
+
+
+def run_fsl(img, tmp_dir):
+    """Deface with BET + Quickshear; returns the brain mask and volume."""
+
+    in_file = os.path.join(tmp_dir, "phantom.nii.gz")
+    nb.save(img, in_file)
+    subprocess.run(["bet", in_file, os.path.join(tmp_dir, "brain"), "-m"],
+                   check=True)
+    mask_img = nb.load(os.path.join(tmp_dir, "brain_mask.nii.gz"))
+    defaced = quickshear(img, mask_img)
+    return np.asanyarray(mask_img.dataobj) > 0, np.asanyarray(defaced.dataobj)
+
+
+def main(voxel_size=1.0):
+    img, truth = make_phantom(voxel_size)
+    print("Phantom: {0} voxels of {1} mm".format(img.shape, voxel_size))
+
+    data = np.asanyarray(img.dataobj).copy()
+    start = time.perf_counter()
+    mask = brain_mask(data, img.header.get_zooms())
+    mask_time = time.perf_counter() - start
+    start = time.perf_counter()
+    deface(data, img.affine, mask)
+    shear_time = time.perf_counter() - start
+    kept = data != 0
+    print("Built-in: {0:.2f} s (mask {1:.2f} s, shear {2:.3f} s)".format(
+        mask_time + shear_time, mask_time, shear_time))
+    print("  brain mask Dice with ground truth: {0:.4f}".format(
+        dice(mask, truth)))
+    print("  brain voxels removed by defacing: {0}".format(
+        np.count_nonzero(truth & ~kept)))
+
+    start = time.perf_counter()
+    reference = np.asanyarray(quickshear(
+        img, nb.Nifti1Image(mask.astype(np.uint8), img.affine)).dataobj)
+    print("Quickshear on the same mask: {0:.3f} s, kept voxels "
+          "Dice {1:.4f}".format(time.perf_counter() - start,
+                                dice(kept, reference != 0)))
+
+    if shutil.which("bet") is None:
+        print("BET + Quickshear: skipped (FSL not found)")
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        fsl_mask, fsl_data = run_fsl(img, tmp_dir)
+        fsl_time = time.perf_counter() - start
+    print("BET + Quickshear: {0:.2f} s".format(fsl_time))
+    print("  brain mask Dice with ground truth: {0:.4f}, with built-in: "
+          "{1:.4f}".format(dice(fsl_mask, truth), dice(fsl_mask, mask)))
+    print("  kept voxels Dice with built-in: {0:.4f}".format(
+        dice(fsl_data != 0, kept)))
+
+
+if __name__ == "__main__":
+    main(*[float(x) for x in sys.argv[1:]])
@@ -0,0 +1,287 @@
+"""Benchmark of the pseudonimization pipeline on synthetic sessions.
+
+Runs pseudonimize_dicoms on synthetic sessions (see synthetic.py) of several
+configurations, and measures the end-to-end time (of the first run, and of
+a second run, which finds everything up to date), the time per session, and
+the files per second and peak memory of each stage (from the profile in the
+report), as well as the time and memory it takes to import pseudicom. External
+programs are replaced by local stand-ins if they are not found, or with
+--native: the native converter for dcm2niix, and the native defacer for
+BET + Quickshear.
+
+The results are written as JSON (--output), which can serve as the baseline
+of a later run (--baseline): a drop in files per second, or a rise in peak
+memory, of more than the tolerance is flagged as a regression (and the exit
+status is 1). Baselines only compare well on the same machine, e.g.:
+
+    python benchmarks/bench_pipeline.py --output baseline.json
+    (apply changes)
+    python benchmarks/bench_pipeline.py --baseline baseline.json
+
+Usage: python benchmarks/bench_pipeline.py [--config NAME ...] [--native]
+       [--plugin PLUGIN] [--n-procs N] [--output FILE] [--baseline FILE]
+       [--tolerance FRACTION]
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import nipype
+import pydicom
+
+from pseudicom import pseudonimize_dicoms
+from pseudicom._profiling import summarize
+
+from synthetic import make_session
+
+
+# Keyword arguments of make_session, number of sessions and further
+# arguments of pseudonimize_dicoms per configuration
+_CONFIGS = {
+    "single-frame": ({"n_series": 4, "n_slices": 64, "n_elements": 200},
+                     1, {}),
+    "multi-frame": ({"n_series": 4, "n_slices": 64, "n_elements": 200,
+                     "multiframe": True}, 1, {}),
+    "large-headers": ({"n_series": 4, "n_slices": 64, "n_elements": 800,
+                       "nested": 5, "anatomical": False}, 1, {}),
+    "many-files": ({"n_series": 16, "n_slices": 128, "matrix": 32,
+                    "n_elements": 100, "anatomical": False}, 1, {}),
+    # The overhead per session, with and without Nipype
+    "anonymize-only": ({"n_series": 2, "n_slices": 16, "n_elements": 200,
+                        "anatomical": False},
+                       8, {"deface": False, "plugin": None}),
+    "anonymize-only-nipype": ({"n_series": 2, "n_slices": 16,
+                               "n_elements": 200, "anatomical": False},
+                              8, {"deface": False}),
+}
+
+# Metrics that are compared with the baseline, and whether higher is better
+_METRICS = {
+    "files_per_second": True,
+    "peak_rss_mb": False,
+}
+
+# Stages that took less time (in seconds) in the baseline are too noisy to
+# compare
+_MIN_SECONDS = 0.1
+
+_IMPORT = """
+import time, resource
+start = time.perf_counter()
+import pseudicom
+print(time.perf_counter() - start,
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def _tools(native):
+    """Choose the converter and defacer (local stand-ins for the external
+    programs that are not available)."""
+
+    converter = "dcm2niix" if shutil.which("dcm2niix") and not native \
+        else "native"
+    defacer = "bet" if shutil.which("bet") and not native else "native"
+    return converter, defacer
+
+
+def run_import(n_runs=3):
+    """Benchmark the import of pseudicom (in a fresh interpreter), taking
+    the fastest of several runs."""
+
+    runs = []
+    for _ in range(n_runs):
+        output = subprocess.run([sys.executable, "-c", _IMPORT], check=True,
+                                capture_output=True, text=True).stdout
+        seconds, max_rss = output.split()
+        runs.append((float(seconds), int(max_rss) / 1024))
+    seconds, peak_rss_mb = min(runs)
+    return {"files": 0, "megabytes": 0.0, "slices_written": 0,
+            "stages": {"import": {"files_per_second": None,
+                                  "seconds": seconds,
+                                  "peak_rss_mb": peak_rss_mb}}}
+
+
+def run_config(config, work_dir, converter, defacer, plugin, n_procs):
+    """Benchmark a single configuration (see _CONFIGS)."""
+
+    session_kwargs, n_sessions, options = _CONFIGS[config]
+    sessions = [os.path.join(work_dir, "session{0}".format(c))
+                for c in range(n_sessions)]
+    files = [f for session in sessions
+             for f in make_session(session, **session_kwargs)]
+    size = sum(os.path.getsize(f) for f in files)
+    kwargs = {"output_dir": [os.path.join(work_dir, "output",
+                                          os.path.basename(session))
+                             for session in sessions],
+              "work_dir": os.path.join(work_dir, "nipype"),
+              "plugin": plugin, "n_procs": n_procs,
+              "converter": converter, "defacer": defacer}
+    kwargs.update(options)
+
+    start = time.perf_counter()
+    reports = pseudonimize_dicoms(sessions, **kwargs)
+    seconds = time.perf_counter() - start
+    for report in reports.values():
+        if not report["succeeded"]:
+            raise RuntimeError("{0} failed: {1}".format(
+                config, report["failed_nodes"] or report["errors"]))
+    start = time.perf_counter()
+    reruns = pseudonimize_dicoms(sessions, **kwargs)
+    rerun_seconds = time.perf_counter() - start
+    if not all(rerun["up_to_date"] for rerun in reruns.values()):
+        raise RuntimeError("{0} was not up to date when run again".format(
+            config))
+
+    stages = {"end_to_end": {"files_per_second": len(files) / seconds,
+                             "seconds": seconds,
+                             "peak_rss_mb": None},
+              "per_session": {"files_per_second": None,
+                              "seconds": seconds / n_sessions,
+                              "peak_rss_mb": None},
+              "up_to_date": {"files_per_second": len(files) / rerun_seconds,
+                             "seconds": rerun_seconds,
+                             "peak_rss_mb": None}}
+    iterations = [entry for report in reports.values()
+                  for entry in report["profile"]["iterations"]]
+    for stage, summary in summarize(iterations).items():
+        stages[stage] = {"files_per_second": summary["files_per_second"],
+                         "seconds": summary["wall_time"],
+                         "peak_rss_mb": summary["peak_rss_mb"]}
+    return {"files": len(files), "megabytes": size / 1024 ** 2,
+            "slices_written": sum(report["slices_written"]
+                                  for report in reports.values()),
+            "stages": stages}
+
+
+def compare(results, baseline, tolerance):
+    """Compare results with a baseline.
+
+    The seconds are compared for stages that do not count files.
+
+    Returns a list of the regressions, as (config, stage, metric, baseline
+    value, value) tuples.
+
+    """
+
+    regressions = []
+    for config, result in results["configs"].items():
+        base = baseline["configs"].get(config)
+        if base is None:
+            continue
+        for stage, metrics in result["stages"].items():
+            base_metrics = base["stages"].get(stage, {})
+            if (base_metrics.get("seconds") or 0) < _MIN_SECONDS:
+                continue
+            for metric, higher_is_better in _METRICS.items():
+                if metric == "files_per_second" and \
+                        metrics.get(metric) is None:
+                    metric, higher_is_better = "seconds", False
+                old = base_metrics.get(metric)
+                new = metrics.get(metric)
+                if old is None or new is None:
+                    continue
+                if higher_is_better:
+                    regressed = new < old * (1 - tolerance)
+                else:
+                    regressed = new > old * (1 + tolerance)
+                if regressed:
+                    regressions.append((config, stage, metric, old, new))
+    return regressions
+
+
+def _format(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def _print_result(config, result):
+    print("{0}: {1} files ({2:.1f} MB)".format(
+        config, result["files"], result["megabytes"]))
+    for stage, metrics in result["stages"].items():
+        print("  {0:>14}: {1:>8} files/s {2:>8} s {3:>8} MB".format(
+            stage, _format(metrics["files_per_second"], ".1f"),
+            _format(metrics["seconds"], ".3f"),
+            _format(metrics["peak_rss_mb"], ".1f")))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark pseudonimize_dicoms on synthetic sessions.")
+    parser.add_argument("--config", nargs="+", choices=sorted(_CONFIGS),
+                        default=sorted(_CONFIGS),
+                        help="the configurations to run (default: all)")
+    parser.add_argument("--native", action="store_true",
+                        help="use the native converter and defacer, even "
+                             "if dcm2niix and FSL are available")
+    parser.add_argument("--plugin", default="Linear",
+                        help="the Nipype plugin (default: Linear)")
+    parser.add_argument("--n-procs", type=int, default=None,
+                        help="the number of processes for MultiProc")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline",
+                        help="compare the results with this (former) "
+                             "results file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="the relative change that is flagged as "
+                             "a regression (default: 0.2)")
+    args = parser.parse_args(argv)
+    nipype.config.set("logging", "workflow_level", "WARNING")
+    nipype.logging.update_logging(nipype.config)
+
+    converter, defacer = _tools(args.native)
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pydicom": pydicom.__version__,
+            "nipype": nipype.__version__,
+            "converter": converter,
+            "defacer": defacer,
+            "plugin": args.plugin,
+        },
+        "configs": {},
+    }
+    print("Converter: {0}, defacer: {1}, plugin: {2}".format(
+        converter, defacer, args.plugin))
+    results["configs"]["startup"] = run_import()
+    _print_result("startup", results["configs"]["startup"])
+    for config in args.config:
+        with tempfile.TemporaryDirectory() as work_dir:
+            result = run_config(config, work_dir, converter, defacer,
+                                args.plugin, args.n_procs)
+        results["configs"][config] = result
+        _print_result(config, result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    for key in ("converter", "defacer", "plugin"):
+        if baseline["environment"].get(key) != results["environment"][key]:
+            print("Warning: the baseline was run with {0} {1!r}".format(
+                key, baseline["environment"].get(key)))
+    regressions = compare(results, baseline, args.tolerance)
+    for config, stage, metric, old, new in regressions:
+        print("REGRESSION {0}/{1}: {2} {3:.3g} -> {4:.3g}".format(
+            config, stage, metric, old, new))
+    if not regressions:
+        print("No regressions (tolerance {0:.0%})".format(args.tolerance))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
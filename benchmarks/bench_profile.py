@@ -0,0 +1,113 @@
+"""Micro-benchmark of the anonymization rules on a synthetic header.
+
+Compares the compiled AnonymizationProfile with the former per-element
+implementation (string comparisons against the list of tags to clear, and
+two passes over the dataset).
+
+Usage: python benchmarks/bench_profile.py [n_elements] [n_files]
+
+"""
+
+
+import io
+import sys
+import time
+import inspect
+
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from pseudicom import pseudonimize_dicoms
+from pseudicom._profile import AnonymizationProfile
+
+from synthetic import add_elements
+
+
+def make_header(n_elements):
+    """Make a serialized DICOM header with n_elements elements."""
+
+    tags_to_clear = inspect.signature(
+        pseudonimize_dicoms).parameters["tags_to_clear"].default
+    d = Dataset()
+    d.file_meta = FileMetaDataset()
+    d.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    d.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    d.StudyDate = "20210304"
+    add_elements(d, n_elements)
+    for group in range(0x0009, 0x0019, 2):  # some private elements
+        block = d.private_block(group, "BENCHMARK", create=True)
+        for element in range(0x10):
+            block.add_new(element, "LO", "private")
+    buffer = io.BytesIO()
+    d.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue(), tags_to_clear
+
+
+def legacy_anonymize(d, tags_to_clear, new_date, remove_private):
+    """The former implementation of the anonymization rules."""
+
+    if remove_private:
+        d.remove_private_tags()
+    dates = []
+    for element in d:
+        if element.VR == "DA":
+            dates.append(element.value)
+    for element in d:
+        if str(element.tag) in tags_to_clear:
+            element.value = ""
+        elif new_date:
+            if element.VR == "SQ":
+                for s in element:
+                    for e in s:
+                        if e.VR in ("DA", "DT", "UI"):
+                            for date in dates:
+                                if date in str(e.value):
+                                    e.value = str(e.value).replace(
+                                        date, new_date)
+                                break
+                        elif str(e.value) in dates:
+                            e.value = new_date
+            elif element.VR in ("DA", "DT", "UI"):
+                for date in dates:
+                    if date in str(element.value):
+                        element.value = str(element.value).replace(
+                            date, new_date)
+                        break
+            elif str(element.value) in dates:
+                element.value = new_date
+    return dates
+
+
+def files_per_second(function, header, n_files):
+    start = time.perf_counter()
+    for _ in range(n_files):
+        function(pydicom.dcmread(io.BytesIO(header)))
+    return n_files / (time.perf_counter() - start)
+
+
+def main(n_elements=1000, n_files=200):
+    header, tags_to_clear = make_header(n_elements)
+    # pydicom>=3 formats tags as "(GGGG,EEEE)", which the string comparisons
+    # of the former implementation need to match
+    legacy_tags = [t.replace(" ", "").upper() for t in tags_to_clear]
+    profile = AnonymizationProfile(tags_to_clear, "19000101", True)
+
+    before = pydicom.dcmread(io.BytesIO(header))
+    legacy_anonymize(before, legacy_tags, "19000101", True)
+    after = pydicom.dcmread(io.BytesIO(header))
+    profile.apply(after)
+    assert before == after, "Results differ"
+
+    n = len(pydicom.dcmread(io.BytesIO(header)))
+    print("Synthetic header: {0} elements, {1} bytes".format(n, len(header)))
+    for name, function in [
+            ("before", lambda d: legacy_anonymize(d, legacy_tags, "19000101",
+                                                  True)),
+            ("after", profile.apply)]:
+        print("{0:>8}: {1:8.1f} files/s".format(
+            name, files_per_second(function, header, n_files)))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,194 @@
+"""End-to-end check and benchmark of the DICOM receiver on localhost.
+
+Sends a synthetic session (see synthetic.py) with pynetdicom to a
+DicomReceiver, over one or more associations, and checks that every instance
+is confirmed with a success status only once it has been written (and
+anonymized), and that all instances are stored. A receiver that cannot write
+its output must report a failure status instead. The number of instances
+stored per second is printed for each number of associations. The exit
+status is 1 if a check fails.
+
+Usage: python benchmarks/bench_receiver.py [--associations N ...]
+       [--n-series N] [--n-slices N] [--port PORT] [--workers N]
+
+"""
+
+
+import os
+import sys
+import glob
+import time
+import argparse
+import tempfile
+import threading
+
+import pydicom
+from pynetdicom import AE, StoragePresentationContexts
+
+from pseudicom import DicomReceiver
+
+from synthetic import make_session
+
+
+_SUCCESS = 0x0000
+
+
+def send(files, port, n_associations, check_dir=None):
+    """Send files to a Storage SCP on localhost, over several associations
+    (in parallel).
+
+    Parameters
+    ----------
+    files : list
+        the DICOM files to send
+    port : int
+        the port of the Storage SCP
+    n_associations : int
+        the number of associations to send the files over
+    check_dir : str, optional
+        if given, the output directory of the receiver, in which each
+        instance must exist once its storage is confirmed
+
+    Returns
+    -------
+    statuses : list
+        the (file, status) of each sent file (status None if the file could
+        not be sent)
+    problems : list
+        the files whose storage was confirmed before they were written
+
+    """
+
+    statuses = []
+    problems = []
+    lock = threading.Lock()
+
+    def _send(chunk):
+        ae = AE(ae_title="BENCH")
+        ae.requested_contexts = StoragePresentationContexts
+        assoc = ae.associate("127.0.0.1", port, ae_title="PSEUDICOM")
+        if not assoc.is_established:
+            with lock:
+                statuses.extend((f, None) for f in chunk)
+            return
+        for f in chunk:
+            d = pydicom.dcmread(f)
+            status = assoc.send_c_store(d)
+            status = status.Status if status else None
+            written = True
+            if status == _SUCCESS and check_dir is not None:
+                written = bool(glob.glob(os.path.join(
+                    check_dir, "*", "*", d.SOPInstanceUID + ".dcm")))
+            with lock:
+                statuses.append((f, status))
+                if not written:
+                    problems.append(f)
+        assoc.release()
+
+    threads = [threading.Thread(target=_send,
+                                args=(files[c::n_associations],))
+               for c in range(n_associations)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses, problems
+
+
+def run(files, work_dir, port, n_associations, n_workers):
+    """Send the files to a new receiver, and check what it stored.
+
+    Returns the instances stored per second and a list of failed checks.
+
+    """
+
+    output_dir = os.path.join(work_dir, "output{0}".format(n_associations))
+    receiver = DicomReceiver(output_dir, port=port, address="127.0.0.1",
+                             n_workers=n_workers, series_timeout=1.0,
+                             deface=False, report_interval=3600.0)
+    receiver.start()
+    try:
+        start = time.perf_counter()
+        statuses, problems = send(files, port, n_associations, output_dir)
+        seconds = time.perf_counter() - start
+    finally:
+        receiver.stop()
+
+    failures = ["{0}: stored before it was written".format(f)
+                for f in problems]
+    failures.extend("{0}: status {1}".format(f, status)
+                    for f, status in statuses if status != _SUCCESS)
+    stored = glob.glob(os.path.join(output_dir, "*", "*", "*.dcm"))
+    if len(stored) != len(files):
+        failures.append("{0} of {1} instances stored".format(
+            len(stored), len(files)))
+    for f in stored[:10]:
+        d = pydicom.dcmread(f, stop_before_pixels=True)
+        if d.get("PatientName") or d.get("StudyDate"):
+            failures.append("{0}: not anonymized".format(f))
+    stats = receiver.stats()
+    if stats["stored"] != len(files) or stats["failed"]:
+        failures.append("stats: {0}".format(stats))
+    return len(files) / seconds, failures
+
+
+def run_failing(files, work_dir, port):
+    """Send files to a receiver that cannot write its output, which must
+    report a failure status for each of them.
+
+    Returns a list of failed checks.
+
+    """
+
+    output_dir = os.path.join(work_dir, "not_a_directory")
+    with open(output_dir, "w"):
+        pass
+    receiver = DicomReceiver(output_dir, port=port, address="127.0.0.1",
+                             series_timeout=1.0, deface=False,
+                             report_interval=3600.0)
+    receiver.start()
+    try:
+        statuses, _ = send(files, port, 1)
+    finally:
+        receiver.stop()
+    return ["{0}: status {1} (expected a failure)".format(f, status)
+            for f, status in statuses
+            if status is None or status == _SUCCESS]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check and benchmark the DICOM receiver on localhost.")
+    parser.add_argument("--associations", type=int, nargs="+",
+                        default=[1, 4],
+                        help="the numbers of associations to send over "
+                             "(default: 1 4)")
+    parser.add_argument("--n-series", type=int, default=4)
+    parser.add_argument("--n-slices", type=int, default=64)
+    parser.add_argument("--port", type=int, default=11113)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="the number of workers of the receiver")
+    args = parser.parse_args(argv)
+
+    failures = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        files = make_session(os.path.join(work_dir, "session"),
+                             n_series=args.n_series, n_slices=args.n_slices,
+                             anatomical=False)
+        for n_associations in args.associations:
+            per_second, run_failures = run(files, work_dir, args.port,
+                                           n_associations, args.workers)
+            print("{0} association(s): {1:.1f} instances/s".format(
+                n_associations, per_second))
+            failures.extend(run_failures)
+        failures.extend(run_failing(files[:4], work_dir, args.port))
+
+    for failure in failures:
+        print("FAILED {0}".format(failure))
+    if not failures:
+        print("All {0} instances were stored".format(len(files)))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Check of resuming a run that was interrupted while defacing.
+
+Pseudonimizes a synthetic session (see synthetic.py) with a PseudonymMap,
+once without interruption, and once interrupted after a number of defaced
+files have replaced the anonymized ones (simulated by failing the
+replacements from then on), followed by a second run that resumes it. As
+a file that is anonymized twice gets pseudonyms of pseudonyms (and its dates
+shifted twice), the resumed session must be identical to the session that
+was not interrupted. The exit status is 1 if it is not.
+
+Usage: python benchmarks/check_resume.py [--interrupt-after N ...]
+
+"""
+
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+from nipype import config
+
+from pseudicom import pseudonimize_dicoms, PseudonymMap
+from pseudicom._scan import scan_session
+
+from synthetic import make_session
+
+
+_KEY = b"check_resume"
+
+_OPTIONS = {"converter": "native", "defacer": "native", "plugin": "Linear",
+            "make_backup": False}
+
+
+def _contents(directory):
+    """Get the contents of the DICOM files of a session, by path relative to
+    the session directory."""
+
+    contents = {}
+    for files in scan_session(directory, "[0-9][0-9][0-9]-.+").runs.values():
+        for f in files:
+            with open(f.path, "rb") as fp:
+                contents[os.path.relpath(f.path, directory)] = fp.read()
+    return contents
+
+
+class _Interrupt(Exception):
+    pass
+
+
+def run_interrupted(directory, work_dir, interrupt_after):
+    """Pseudonimize a session, failing the replacement of defaced files
+    after a number of them, and resume it."""
+
+    replace = os.replace
+    n_replaced = 0
+
+    def failing_replace(src, dst):
+        nonlocal n_replaced
+        if str(src).endswith(".tmp_deface"):
+            if n_replaced >= interrupt_after:
+                raise _Interrupt("interrupted after {0} files".format(
+                    n_replaced))
+            n_replaced += 1
+        replace(src, dst)
+
+    os.replace = failing_replace
+    try:
+        pseudonimize_dicoms(directory, work_dir=work_dir,
+                            pseudonyms=PseudonymMap(_KEY), **_OPTIONS)
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError("The first run was not interrupted")
+    finally:
+        os.replace = replace
+    return pseudonimize_dicoms(directory, work_dir=work_dir,
+                               pseudonyms=PseudonymMap(_KEY), **_OPTIONS)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check resuming a run that was interrupted while "
+                    "defacing.")
+    parser.add_argument("--interrupt-after", type=int, nargs="+",
+                        default=[0, 20],
+                        help="the numbers of defaced files that replace the "
+                             "anonymized ones before the interruption "
+                             "(default: 0 20)")
+    args = parser.parse_args(argv)
+
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Keep the crash files of the interrupted runs out of the way
+        config.set("execution", "crashdump_dir", tmp_dir)
+        source = os.path.join(tmp_dir, "source")
+        make_session(source, n_series=1, n_slices=8, n_elements=50,
+                     anatomical_voxel_size=2.0)
+        expected_dir = os.path.join(tmp_dir, "expected")
+        shutil.copytree(source, expected_dir)
+        report = pseudonimize_dicoms(
+            expected_dir, work_dir=os.path.join(tmp_dir, "work_expected"),
+            pseudonyms=PseudonymMap(_KEY), **_OPTIONS)
+        if not report[expected_dir]["slices_written"]:
+            failures.append("nothing was defaced")
+        expected = _contents(expected_dir)
+        for n in args.interrupt_after:
+            directory = os.path.join(tmp_dir, "interrupted{0}".format(n))
+            shutil.copytree(source, directory)
+            report = run_interrupted(
+                directory, os.path.join(tmp_dir, "work{0}".format(n)), n)
+            contents = _contents(directory)
+            if set(contents) != set(expected):
+                failures.append("interrupted after {0}: files {1}".format(
+                    n, sorted(set(contents) ^ set(expected))))
+                continue
+            differ = [f for f in expected if contents[f] != expected[f]]
+            if differ:
+                failures.append("interrupted after {0}: {1} of {2} files "
+                                "differ (e.g. {3})".format(
+                                    n, len(differ), len(expected),
+                                    differ[0]))
+            print("Interrupted after {0} files: resumed {1}".format(
+                n, "identically" if not differ else "with differences"))
+
+    for failure in failures:
+        print("FAILED {0}".format(failure))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
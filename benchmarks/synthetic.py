@@ -0,0 +1,280 @@
+"""Synthetic DICOM sessions for benchmarks.
+
+A session holds a number of 2D (functional-like) series of random noise, and
+optionally a 3D anatomical series of the head phantom of bench_deface, which
+is detected as anatomical and defaced. The series are either single-frame
+(one file per slice, with the acquisition date in the file names, as on
+Siemens scanners) or enhanced multi-frame (one file per series).
+
+Each header is padded with standard elements (of the groups that do not
+describe the image) up to a number of elements, and holds identifying
+information, dates, private elements and nested sequences.
+
+Usage: python benchmarks/synthetic.py directory [n_series] [n_slices]
+       [n_elements] [--multiframe]
+
+"""
+
+
+import os
+import sys
+import copy
+
+import numpy as np
+from pydicom.datadict import DicomDictionary
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import (ExplicitVRLittleEndian, MRImageStorage,
+                         EnhancedMRImageStorage, generate_uid)
+
+from bench_deface import make_phantom
+
+
+_VALUES = {
+    "AE": "STATION", "AS": "042Y", "CS": "VALUE", "DA": "20210304",
+    "DS": "1.5", "DT": "20210304101010", "IS": "42", "LO": "Long String",
+    "LT": "Long Text", "PN": "Doe^John", "SH": "Short", "ST": "Short Text",
+    "TM": "101010", "UC": "Unlimited", "UI": "1.2.3.20210304.4",
+    "UT": "Unlimited Text", "FL": 1.5, "FD": 1.5, "SL": 42, "SS": 42,
+    "UL": 42, "US": 42,
+}
+
+# Groups of standard elements to pad the headers of a session with (which
+# leave the image and its geometry alone)
+_PADDING_GROUPS = (0x0008, 0x0010, 0x0032, 0x0038, 0x0040)
+
+_DATE = "20210304"
+
+
+def add_elements(d, n_elements, groups=None):
+    """Add standard (non-retired) elements to a dataset, in the order of the
+    DICOM dictionary, until it has n_elements elements.
+
+    Parameters
+    ----------
+    d : pydicom.dataset.Dataset
+        the dataset
+    n_elements : int
+        the number of elements to reach
+    groups : tuple, optional
+        if given, only add elements of these groups
+
+    """
+
+    for tag, entry in sorted(DicomDictionary.items()):
+        if len(d) >= n_elements:
+            break
+        vr, vm, keyword, retired = entry[:4]
+        if tag >> 16 in (0x0000, 0x0002, 0xFFFE) or tag == 0x00080005 \
+                or vr not in _VALUES or retired or tag in d:
+            continue
+        if groups is not None and tag >> 16 not in groups:
+            continue
+        d.add_new(tag, vr, _VALUES[vr])
+
+
+def _nested_item(depth):
+    """Make an item of a sequence, with identifying information, dates and
+    UIDs, holding a sequence itself (depth - 1 levels deep)."""
+
+    item = Dataset()
+    item.PatientName = "Nested^Name"
+    item.StudyDate = _DATE
+    item.ReferencedSOPClassUID = MRImageStorage
+    item.ReferencedSOPInstanceUID = "1.2.3.{0}.{1}".format(_DATE, depth)
+    if depth > 1:
+        item.ReferencedStudySequence = [_nested_item(depth - 1)]
+    return item
+
+
+def _header(sop_class, n_elements, nested):
+    """Make the common header of the files of a session."""
+
+    d = Dataset()
+    d.file_meta = FileMetaDataset()
+    d.file_meta.MediaStorageSOPClassUID = sop_class
+    d.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    d.SOPClassUID = sop_class
+    d.Modality = "MR"
+    for keyword in ("StudyDate", "SeriesDate", "AcquisitionDate",
+                    "ContentDate"):
+        setattr(d, keyword, _DATE)
+    d.StudyTime = "101010"
+    d.PatientName = "Doe^John"
+    d.PatientID = "P01"
+    d.PatientBirthDate = "19800101"
+    d.InstitutionName = "Hospital"
+    d.StudyInstanceUID = "1.2.3.{0}.1".format(_DATE)
+    add_elements(d, n_elements, _PADDING_GROUPS)
+    d.private_block(0x0029, "SIEMENS CSA HEADER", create=True).add_new(
+        0x10, "OB", b"\x01" * 1024)
+    if nested:
+        d.RequestAttributesSequence = [_nested_item(nested)]
+    return d
+
+
+def _set_image(d, data, voxel_size):
+    """Set the image attributes of a dataset for a volume of frames
+    (data[:, :, k].T being the k-th frame)."""
+
+    d.Rows, d.Columns = data.shape[1], data.shape[0]
+    d.BitsAllocated = 16
+    d.BitsStored = 12
+    d.HighBit = 11
+    d.PixelRepresentation = 0
+    d.SamplesPerPixel = 1
+    d.PhotometricInterpretation = "MONOCHROME2"
+    d.PixelSpacing = [voxel_size, voxel_size]
+    d.SliceThickness = voxel_size
+    d.PixelData = np.ascontiguousarray(
+        data.transpose(2, 1, 0).astype(np.uint16)).tobytes()
+
+
+def write_series(run_dir, header, data, voxel_size, description,
+                 acquisition, multiframe=False):
+    """Write a volume as a series of axial slices.
+
+    Parameters
+    ----------
+    run_dir : str
+        the run directory to write
+    header : pydicom.dataset.Dataset
+        the common header (see _header)
+    data : numpy.ndarray
+        the volume (in LPS orientation, with data[:, :, k].T being the k-th
+        slice from the bottom)
+    voxel_size : float
+        the (isotropic) voxel size, in mm
+    description : str
+        the SeriesDescription
+    acquisition : str
+        the MRAcquisitionType ("2D" or "3D")
+    multiframe : bool, optional
+        if True, write a single enhanced multi-frame file instead of a file
+        per slice
+
+    Returns
+    -------
+    files : list
+        the written files
+
+    """
+
+    os.makedirs(run_dir, exist_ok=True)
+    series = copy.deepcopy(header)
+    series.SeriesInstanceUID = generate_uid()
+    series.SeriesDescription = description
+    series.MRAcquisitionType = acquisition
+    series.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    if multiframe:
+        series.ImageType = ["ORIGINAL", "PRIMARY", "M", "NONE"]
+        series.NumberOfFrames = data.shape[2]
+        orientation = Dataset()
+        orientation.ImageOrientationPatient = \
+            series.pop("ImageOrientationPatient").value
+        measures = Dataset()
+        measures.PixelSpacing = [voxel_size, voxel_size]
+        measures.SliceThickness = voxel_size
+        shared = Dataset()
+        shared.PlaneOrientationSequence = [orientation]
+        shared.PixelMeasuresSequence = [measures]
+        series.SharedFunctionalGroupsSequence = [shared]
+        frames = []
+        for k in range(data.shape[2]):
+            position = Dataset()
+            position.ImagePositionPatient = [0, 0, k * voxel_size]
+            frame = Dataset()
+            frame.PlanePositionSequence = [position]
+            frames.append(frame)
+        series.PerFrameFunctionalGroupsSequence = frames
+        slices = [(series, data)]
+    else:
+        series.ImageType = ["ORIGINAL", "PRIMARY", "M", "ND"]
+        slices = []
+        for k in range(data.shape[2]):
+            d = Dataset()
+            d.update(series)  # copy.copy would share the dict of elements
+            d.ImagePositionPatient = [0, 0, k * voxel_size]
+            slices.append((d, data[:, :, k:k + 1]))
+    files = []
+    for c, (d, pixels) in enumerate(slices):
+        d.SOPInstanceUID = generate_uid()
+        d.file_meta = copy.deepcopy(header.file_meta)
+        d.file_meta.MediaStorageSOPInstanceUID = d.SOPInstanceUID
+        d.InstanceNumber = c + 1
+        _set_image(d, pixels, voxel_size)
+        out_file = os.path.join(run_dir, "IMG_{0}_{1:04d}.IMA".format(
+            _DATE, c + 1))
+        d.save_as(out_file, enforce_file_format=True)
+        files.append(out_file)
+    return files
+
+
+def make_session(directory, n_series=4, n_slices=32, matrix=64,
+                 n_elements=200, nested=2, multiframe=False, anatomical=True,
+                 anatomical_voxel_size=1.0, seed=0):
+    """Make a synthetic session.
+
+    Parameters
+    ----------
+    directory : str
+        the session directory to write
+    n_series : int, optional
+        the number of 2D series (of 3 mm voxels)
+    n_slices : int, optional
+        the number of slices of a 2D series
+    matrix : int, optional
+        the number of rows and columns of a 2D series
+    n_elements : int, optional
+        the number of standard elements of each header (at least)
+    nested : int, optional
+        the depth of the nested sequence of each header (0 for none)
+    multiframe : bool, optional
+        if True, write enhanced multi-frame files
+    anatomical : bool, optional
+        if True, add an anatomical series of the head phantom
+    anatomical_voxel_size : float, optional
+        the voxel size of the anatomical series (in mm)
+    seed : int, optional
+        the seed of the random noise
+
+    Returns
+    -------
+    files : list
+        the written files
+
+    """
+
+    rng = np.random.default_rng(seed)
+    sop_class = EnhancedMRImageStorage if multiframe else MRImageStorage
+    header = _header(sop_class, n_elements, nested)
+    files = []
+    for c in range(n_series):
+        data = rng.integers(0, 4000, (matrix, matrix, n_slices))
+        files.extend(write_series(
+            os.path.join(directory, "{0:03d}-bold_run{1}".format(c + 1, c)),
+            header, data, 3.0, "bold_run{0}".format(c), "2D", multiframe))
+    if anatomical:
+        img, truth = make_phantom(anatomical_voxel_size, seed)
+        # RAS to LPS
+        data = np.clip(np.asanyarray(img.dataobj)[::-1, ::-1, :], 0, None)
+        files.extend(write_series(
+            os.path.join(directory, "{0:03d}-t1_mprage".format(
+                n_series + 1)),
+            header, data, anatomical_voxel_size, "t1_mprage", "3D",
+            multiframe))
+    return files
+
+
+def main(directory, n_series=4, n_slices=32, n_elements=200,
+         multiframe=False):
+    files = make_session(directory, n_series, n_slices,
+                         n_elements=n_elements, multiframe=multiframe)
+    print("Wrote {0} files ({1:.1f} MB) to {2}".format(
+        len(files), sum(os.path.getsize(f) for f in files) / 1024 ** 2,
+        directory))
+
+
+if __name__ == "__main__":
+    args = [x for x in sys.argv[1:] if x != "--multiframe"]
+    main(args[0], *[int(x) for x in args[1:]],
+         multiframe="--multiframe" in sys.argv)
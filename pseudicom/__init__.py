@@ -1 +1,13 @@
-from ._pseudicom import pseudonimize_dicoms
+from ._pseudicom import pseudonimize_dicoms, pseudonimize_study
+from ._profile import AnonymizationProfile
+from ._pseudonyms import PseudonymMap
+from ._anonymize import anonymize_datasets
+
+
+def __getattr__(name):
+    # The receiver imports pynetdicom (an optional dependency) on first use
+    if name == "DicomReceiver":
+        from ._receiver import DicomReceiver
+        return DicomReceiver
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(
+        __name__, name))
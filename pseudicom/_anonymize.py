@@ -0,0 +1,478 @@
+"""Anonymization of DICOM files and datasets.
+
+"""
+
+
+import io
+import os
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pydicom
+from pydicom.dataset import Dataset
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+from ._files import link_or_copy
+from ._manifest import new_hash
+from ._encoding import encode, transfer_syntax_uid
+
+
+_POOLS = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+}
+
+# Explicit VRs with a 4-byte value length
+_LONG_VRS = (b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC",
+             b"UN", b"UR", b"UT", b"UV")
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _original_encoding(d):
+    """Get (is_implicit_VR, is_little_endian) of a dataset read from file."""
+
+    try:
+        return d.original_encoding
+    except AttributeError:  # pydicom<3
+        return d.is_implicit_VR, d.is_little_endian
+
+
+def _element_end(fp, offset, is_implicit_VR, is_little_endian):
+    """Get the end position of the (pixel data) element at offset."""
+
+    endian = "<" if is_little_endian else ">"
+    fp.seek(offset + 4)
+    if is_implicit_VR:
+        length, = struct.unpack(endian + "L", fp.read(4))
+    else:
+        vr = fp.read(2)
+        if vr in _LONG_VRS:
+            fp.seek(2, os.SEEK_CUR)
+            length, = struct.unpack(endian + "L", fp.read(4))
+        else:
+            length, = struct.unpack(endian + "H", fp.read(2))
+    if length != 0xFFFFFFFF:
+        return fp.tell() + length
+    # Encapsulated pixel data: skip items up to the sequence delimiter
+    while True:
+        item = fp.read(8)
+        if len(item) < 8:
+            raise ValueError("Unterminated encapsulated pixel data")
+        group, element, length = struct.unpack(endian + "HHL", item)
+        if (group, element) == (0xFFFE, 0xE0DD):
+            return fp.tell()
+        fp.seek(length, os.SEEK_CUR)
+
+
+def _read_header(fp):
+    """Read a DICOM file object up to its pixel data (see read_header)."""
+
+    d = pydicom.dcmread(fp, stop_before_pixels=True)
+    pixel_offset = fp.tell()
+    size = fp.seek(0, os.SEEK_END)
+    if pixel_offset >= size:
+        return d, None
+    if d.file_meta.get("TransferSyntaxUID") == DeflatedExplicitVRLittleEndian:
+        return d, None
+    end = _element_end(fp, pixel_offset, *_original_encoding(d))
+    if end != size:
+        return d, None
+    return d, pixel_offset
+
+
+def read_header(in_file):
+    """Read a DICOM file up to (but not including) its pixel data.
+
+    Parameters
+    ----------
+    in_file : str
+        the DICOM file to read
+
+    Returns
+    -------
+    d : pydicom.dataset.FileDataset
+        the dataset without pixel data
+    pixel_offset : int or None
+        the byte offset of the pixel data element in in_file; None if the
+        pixel data cannot be copied over as is (i.e. if the file has no
+        pixel data, is deflated or has further elements after the pixel data)
+
+    """
+
+    with open(in_file, "rb") as fp:
+        return _read_header(fp)
+
+
+def _read(fp, header_only, transfer_syntax=None, source_hash=None):
+    """Read a (seekable) DICOM file object.
+
+    Returns the dataset, and the byte offset of the pixel data that is to be
+    copied over as is (None if the whole file was read, e.g. as its pixel
+    data is to be encoded with another transfer syntax). A given hash
+    object is updated with the contents of the file, if it was read in
+    full (see _write otherwise).
+
+    """
+
+    if header_only:
+        start = fp.tell()
+        d, pixel_offset = _read_header(fp)
+        if pixel_offset is not None and (
+                transfer_syntax is None or
+                d.file_meta.get("TransferSyntaxUID") == transfer_syntax):
+            return d, pixel_offset
+        fp.seek(start)
+    if source_hash is not None:
+        data = fp.read()
+        source_hash.update(data)
+        fp = io.BytesIO(data)
+    return pydicom.dcmread(fp), None
+
+
+def _write(d, out, src=None, pixel_offset=None, output_hash=None,
+           source_hash=None):
+    """Write a dataset to a file object, followed by the pixel data of
+    another (if pixel_offset is given).
+
+    Given hash objects are updated with the written data, and with the
+    contents of the other file (of which the header is read again, and the
+    pixel data while it is copied), such that no file is read twice to hash
+    it.
+
+    """
+
+    # pydicom seeks back within the written data, so it is hashed at once
+    buffer = io.BytesIO()
+    d.save_as(buffer)
+    header = buffer.getbuffer()
+    out.write(header)
+    if output_hash is not None:
+        output_hash.update(header)
+    header.release()
+    if pixel_offset is None:
+        return
+    if source_hash is not None:
+        src.seek(0)
+        source_hash.update(src.read(pixel_offset))
+    src.seek(pixel_offset)
+    for chunk in iter(lambda: src.read(_CHUNK_SIZE), b""):
+        out.write(chunk)
+        for h in (output_hash, source_hash):
+            if h is not None:
+                h.update(chunk)
+
+
+def _anonymize(d, profile, transfer_syntax=None):
+    """Apply the anonymization rules to a dataset in place (and encode it
+    with a transfer syntax, if given), and return the (original) dates
+    found in it."""
+
+    dates = profile.apply(d)
+    if transfer_syntax is not None:
+        encode(d, transfer_syntax)
+    try:
+        d.fix_meta_info()
+    except AttributeError:  # not needed anymore for pydicom>=3
+        pass
+    return dates
+
+
+def _anonymize_source(job):
+    """Anonymize a single dataset, bytes or file object (see
+    anonymize_datasets)."""
+
+    source, profile, header_only, transfer_syntax = job
+    if isinstance(source, Dataset):
+        _anonymize(source, profile, transfer_syntax)
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    elif not hasattr(source, "read"):
+        raise TypeError("Not a dataset, bytes or file object: {0!r}".format(
+            type(source).__name__))
+    elif not source.seekable():
+        source = io.BytesIO(source.read())
+    d, pixel_offset = _read(source, header_only, transfer_syntax)
+    _anonymize(d, profile, transfer_syntax)
+    out = io.BytesIO()
+    _write(d, out, source, pixel_offset)
+    return out.getvalue()
+
+
+def _imap(function, jobs, n_workers=1, pool="thread"):
+    """Lazily map a function over an iterable of jobs, in parallel.
+
+    The results are yielded in the order of the jobs, and at most twice as
+    many jobs as workers are in flight (and taken from the iterable) at any
+    time.
+
+    """
+
+    if pool not in _POOLS:
+        raise ValueError("Unknown pool '{0}' (must be one of {1})".format(
+            pool, ", ".join(sorted(_POOLS))))
+
+    def results():
+        if n_workers is not None and n_workers <= 1:
+            for job in jobs:
+                yield function(job)
+            return
+        n = n_workers or os.cpu_count()
+        with _POOLS[pool](n) as executor:
+            pending = collections.deque()
+            for job in jobs:
+                pending.append(executor.submit(function, job))
+                if len(pending) >= 2 * n:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    return results()
+
+
+def anonymize_datasets(datasets, profile, header_only=False, n_workers=1,
+                       pool="thread", transfer_syntax=None):
+    """Anonymize a stream of DICOM datasets.
+
+    The datasets are taken from the iterable and anonymized lazily (one at
+    a time, or a bounded number at a time with several workers), such that
+    the stream can be of any length, e.g. when receiving datasets over the
+    network.
+
+    Parameters
+    ----------
+    datasets : iterable
+        the datasets to anonymize, each a pydicom.dataset.Dataset (which is
+        anonymized in place), the bytes of a DICOM file, or a binary file
+        object (e.g. an open file, or io.BytesIO) of a DICOM file
+    profile : pseudicom.AnonymizationProfile
+        the anonymization rules to apply
+    header_only : bool, optional
+        if True, only read and rewrite the header of bytes and file objects,
+        and copy their pixel data over as is (see anonymize_file)
+        Default:
+            False
+    n_workers : int, optional
+        the number of datasets to anonymize in parallel (None for the number
+        of CPUs)
+        Default:
+            1
+    pool : str, optional
+        the kind of worker pool ("thread" or "process") to use when
+        n_workers > 1 (file objects cannot be passed to a process pool)
+        Default:
+            "thread"
+    transfer_syntax : str, optional
+        if given, encode the anonymized datasets with this (lossless)
+        transfer syntax: "explicit", "implicit" or "deflated" (explicit VR
+        little endian, compressed with zlib), "rle", "jpeg-ls" or "jpeg2000"
+        (the latter two need the pydicom plugins pyjpegls or
+        pylibjpeg-openjpeg), or its UID; by default, the transfer syntax of
+        each dataset is kept
+        Default:
+            None
+
+    Yields
+    ------
+    anonymized : pydicom.dataset.Dataset or bytes
+        the anonymized dataset for each dataset, and the bytes of the
+        anonymized DICOM file for each bytes or file object, in the order of
+        the input
+
+    Raises
+    ------
+    TypeError
+        if an item of the iterable is not a dataset, bytes or file object
+    ValueError
+        if the transfer syntax is not supported, or cannot be encoded
+
+    """
+
+    transfer_syntax = transfer_syntax_uid(transfer_syntax)
+    return _imap(_anonymize_source,
+                 ((source, profile, header_only, transfer_syntax)
+                  for source in datasets),
+                 n_workers, pool)
+
+
+def _retire(in_file, make_backup):
+    """Remove a source file that was processed in place under a new name
+    (keeping it as a backup, if requested)."""
+
+    backup = in_file + ".bak_anonym"
+    if make_backup and not os.path.exists(backup):
+        os.rename(in_file, backup)
+    else:
+        os.remove(in_file)
+
+
+def anonymize_file(in_file, make_backup, profile, header_only=False,
+                   out_dir=None, manifest=None, transfer_syntax=None):
+    """Anonymize a single DICOM file (in place, by default).
+
+    The anonymized file is written to a temporary file first, which then
+    replaces the output file, such that an interruption never leaves
+    a partially written file, or neither the original nor the anonymized
+    file behind.
+
+    Parameters
+    ----------
+    in_file : str
+        the DICOM file to anonymize
+    make_backup : bool
+        if True, keep the original file as "*.bak_anonym" (an existing backup
+        is never overwritten)
+    profile : pseudicom.AnonymizationProfile
+        the anonymization rules to apply
+    header_only : bool, optional
+        if True, only read and rewrite the header, and copy the pixel data
+        over as is (falls back to reading the whole file if the pixel data
+        cannot be copied over, or is to be encoded with another transfer
+        syntax)
+    out_dir : str, optional
+        if given, write the anonymized file to this directory instead, and
+        leave in_file untouched (no backup is made)
+    manifest : pseudicom._manifest.Manifest, optional
+        if given, record the anonymized file in the manifest, before it
+        replaces the output file (see pseudicom._manifest)
+    transfer_syntax : pydicom.uid.UID, optional
+        if given, encode the anonymized file with this transfer syntax (see
+        pseudicom._encoding.TRANSFER_SYNTAXES) instead of keeping the
+        transfer syntax of in_file
+
+    Returns
+    -------
+    out_file : str
+        the anonymized file (its name differs from in_file if the name
+        contained a date)
+
+    """
+
+    path, name = os.path.split(in_file)
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        path = out_dir
+    source_hash = output_hash = None
+    if manifest is not None:
+        source_hash, output_hash = new_hash(), new_hash()
+    with open(in_file, "rb") as src:
+        d, pixel_offset = _read(src, header_only, transfer_syntax,
+                                source_hash)
+        dates = _anonymize(d, profile, transfer_syntax)
+        for date, new_date in dates.items():
+            if date in name:
+                name = name.replace(date, new_date)
+                break
+        out_file = os.path.join(path, name)
+        tmp_file = out_file + ".tmp_anonym"
+        try:
+            with open(tmp_file, "wb") as out:
+                _write(d, out, src, pixel_offset, output_hash, source_hash)
+            if manifest is not None:
+                source = manifest.source(in_file, source_hash.hexdigest())
+                manifest.append([manifest.record(
+                    out_file, from_file=tmp_file,
+                    contents_hash=output_hash.hexdigest(),
+                    settings=profile.fingerprint, stage="anonymized",
+                    deface_settings=None, **source)])
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+    if out_dir is None and in_file == out_file:
+        backup = in_file + ".bak_anonym"
+        if make_backup and not os.path.exists(backup):
+            link_or_copy(in_file, backup)
+    os.replace(tmp_file, out_file)
+    if out_dir is None and in_file != out_file:
+        _retire(in_file, make_backup)
+    return out_file
+
+
+def _try_anonymize_file(args):
+    """Anonymize a single DICOM file, catching any error, and get the number
+    of bytes saved."""
+
+    (in_file, make_backup, profile, header_only, out_dir, manifest,
+     transfer_syntax) = args
+    try:
+        size = os.path.getsize(in_file)
+        out_file = anonymize_file(in_file, make_backup, profile, header_only,
+                                  out_dir, manifest, transfer_syntax)
+        return out_file, size - os.path.getsize(out_file), None
+    except Exception as e:
+        return None, 0, "{0}: {1}".format(in_file, e)
+
+
+def anonymize_files(in_files, make_backup, profile, header_only=False,
+                    n_workers=1, pool="thread", manifest=None, out_dir=None,
+                    transfer_syntax=None):
+    """Anonymize several DICOM files (in place, by default).
+
+    A file that cannot be anonymized does not stop the others from being
+    processed, but is reported in the returned errors.
+
+    Parameters
+    ----------
+    in_files : list
+        the DICOM files to anonymize
+    make_backup, profile, header_only, out_dir, transfer_syntax
+        see anonymize_file
+    n_workers : int, optional
+        the number of files to process (and encode) in parallel
+    pool : str, optional
+        the kind of worker pool ("thread" or "process") to use when
+        n_workers > 1
+    manifest : pseudicom._manifest.Manifest, optional
+        if given, skip files that have already been anonymized with the same
+        profile according to the manifest (including the source files that
+        an interrupted run anonymized under a new name, but did not remove
+        yet, which are removed now), and record each anonymized file as
+        soon as it is written
+
+    Returns
+    -------
+    out_files : list
+        the anonymized files, in the order of in_files (None for a file that
+        could not be anonymized)
+    errors : list
+        an error message for each file that could not be anonymized
+    bytes_saved : int
+        the total size of the files that were anonymized, minus that of the
+        anonymized files (negative if they grew)
+
+    """
+
+    out_files = list(in_files)
+    todo = list(range(len(in_files)))
+    if manifest is not None:
+        records = manifest.load()
+        stale = []
+        for c, in_file in enumerate(in_files):
+            if manifest.is_current(in_file, records, profile.fingerprint):
+                out_files[c] = manifest.output_of(in_file, records)
+            else:
+                stale.append(c)
+        renamed = manifest.renamed_outputs(records, profile.fingerprint,
+                                           [in_files[c] for c in stale])
+        todo = []
+        for c in stale:
+            in_file = in_files[c]
+            if in_file in renamed and \
+                    manifest.is_source_of(in_file, renamed[in_file][1]):
+                _retire(in_file, make_backup)
+                out_files[c] = renamed[in_file][0]
+            else:
+                todo.append(c)
+    jobs = ((in_files[c], make_backup, profile, header_only, out_dir,
+             manifest, transfer_syntax) for c in todo)
+    results = list(_imap(_try_anonymize_file, jobs, n_workers, pool))
+    for c, (out_file, saved, error) in zip(todo, results):
+        out_files[c] = out_file
+    errors = [error for out_file, saved, error in results
+              if error is not None]
+    if profile.pseudonyms is not None:
+        profile.pseudonyms.flush()
+    return out_files, errors, sum(saved for out_file, saved, error in results)
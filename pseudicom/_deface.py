@@ -0,0 +1,169 @@
+"""Built-in defacing of anatomical volumes.
+
+A NumPy/SciPy alternative to BET (brain extraction) followed by Quickshear.
+The brain mask is a coarse estimate, which only needs to be good enough for
+the shear plane, which Quickshear places along the lower front of the
+(sagittal profile of the) brain.
+
+"""
+
+
+import numpy as np
+import nibabel as nb
+
+
+# Shear plane buffer (in voxels, as in Quickshear)
+_BUFFER = 10
+
+# Threshold of brain tissue (as a fraction of the robust range of the
+# volume), and radius and resolution (in mm) of the opening that separates
+# the brain from the scalp, face and neck
+_TISSUE_THRESHOLD = 0.3
+_EROSION = 12.0
+_OPENING_RESOLUTION = 2.0
+
+
+def _largest_component(mask):
+    """Keep only the largest connected component of a mask."""
+
+    from scipy import ndimage
+    labels, n = ndimage.label(mask)
+    if n == 0:
+        return mask
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    return labels == sizes.argmax()
+
+
+def brain_mask(data, voxel_size, erosion=_EROSION):
+    """Estimate the brain mask of a (T1-weighted) anatomical volume.
+
+    Brain tissue is separated from background, CSF and bone at 30% of the
+    robust range of the volume, and opened (at a resolution of about 2 mm)
+    with a ball of the given radius, which disconnects the brain from the
+    scalp, face and neck (keeping the largest component). The holes of the
+    result are filled.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        the 3D volume
+    voxel_size : sequence
+        the voxel size (in mm) along each axis
+    erosion : float, optional
+        the radius (in mm) of the opening; must be larger than the radius of
+        the connections between the brain and the rest of the head (e.g.
+        the brain stem)
+        Default:
+            12.0
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        the boolean brain mask
+
+    """
+
+    from scipy import ndimage
+    if data.ndim != 3:
+        raise ValueError("Not a 3D volume")
+    low, high = np.percentile(data[::2, ::2, ::2], [2, 98])
+    tissue = data > low + _TISSUE_THRESHOLD * (high - low)
+    # Open at a resolution of about 2 mm
+    steps = [max(1, int(_OPENING_RESOLUTION // x)) for x in voxel_size]
+    sampling = [x * step for x, step in zip(voxel_size, steps)]
+    coarse = tissue[tuple(slice(None, None, step) for step in steps)]
+    core = ndimage.distance_transform_edt(coarse, sampling=sampling) > erosion
+    core = _largest_component(core)
+    coarse = ndimage.distance_transform_edt(~core, sampling=sampling) \
+        <= erosion
+    mask = coarse[np.ix_(*[np.arange(n) // step
+                           for n, step in zip(data.shape, steps)])]
+    mask &= tissue
+    return ndimage.binary_fill_holes(_largest_component(mask))
+
+
+def _rps_view(data, affine):
+    """Get a view of a volume in RPS orientation."""
+
+    transform = nb.orientations.ornt_transform(
+        nb.io_orientation(affine), nb.orientations.axcodes2ornt("RPS"))
+    return nb.orientations.apply_orientation(data, transform)
+
+
+def shear_plane(mask, buff=_BUFFER):
+    """Find the voxels below the Quickshear plane of a brain mask.
+
+    The plane follows the first segment of the lower convex hull of the
+    outline of the sagittal profile of the brain (from anterior to
+    posterior), lowered by the buffer. As only its first segment is needed,
+    the hull is not computed: the segment ends at the lowest point of the
+    outline with the smallest slope.
+
+    Parameters
+    ----------
+    mask : numpy.ndarray
+        the 3D brain mask, in RPS orientation
+    buff : int, optional
+        the distance (in voxels) between the brain and the plane
+        Default:
+            10
+
+    Returns
+    -------
+    below : numpy.ndarray
+        the 2D boolean mask (PS orientation) of the sagittal profile below
+        the plane
+
+    Raises
+    ------
+    ValueError
+        if the brain mask is empty (or flat)
+
+    """
+
+    brain = mask.any(axis=0).astype(np.int8)
+    edge = 4 * brain - np.roll(brain, 1, 0) - np.roll(brain, -1, 0) - \
+        np.roll(brain, 1, 1) - np.roll(brain, -1, 1) != 0
+    xs = np.flatnonzero(edge.any(axis=1))
+    if len(xs) < 2:
+        raise ValueError("Empty brain mask")
+    ys = edge[xs].argmax(axis=1)  # lowest point of each column
+    slope = np.min((ys[1:] - ys[0]) / (xs[1:] - xs[0]))
+    intercept = ys[0] - xs[0] * slope - buff
+    heights = np.trunc(np.arange(mask.shape[1]) * slope + intercept)
+    return np.arange(mask.shape[2])[np.newaxis, :] < heights[:, np.newaxis]
+
+
+def deface(data, affine, mask=None, buff=_BUFFER, fill=0):
+    """Deface an anatomical volume in place.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        the 3D volume (which is modified)
+    affine : numpy.ndarray
+        the 4x4 affine from voxel to RAS coordinates
+    mask : numpy.ndarray, optional
+        the brain mask (by default estimated with brain_mask)
+    buff : int, optional
+        the distance (in voxels) between the brain and the shear plane
+        Default:
+            10
+    fill : number, optional
+        the value to set the voxels below the shear plane to
+        Default:
+            0
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        the brain mask
+
+    """
+
+    if mask is None:
+        mask = brain_mask(data, nb.affines.voxel_sizes(affine))
+    below = shear_plane(_rps_view(mask, affine), buff)
+    _rps_view(data, affine)[:, below] = fill
+    return mask
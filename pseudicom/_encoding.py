@@ -0,0 +1,127 @@
+"""Transfer syntaxes of output files.
+
+"""
+
+
+import threading
+import contextlib
+
+from pydicom.uid import (UID, ExplicitVRLittleEndian, ImplicitVRLittleEndian,
+                         DeflatedExplicitVRLittleEndian, RLELossless,
+                         JPEGLSLossless, JPEG2000Lossless, JPEG2000)
+try:
+    from pydicom.pixels import get_encoder
+except ImportError:  # pydicom<3
+    from pydicom.encoders import get_encoder
+
+
+# Transfer syntaxes that output files can be written with (all lossless)
+TRANSFER_SYNTAXES = {
+    "explicit": ExplicitVRLittleEndian,
+    "implicit": ImplicitVRLittleEndian,
+    "deflated": DeflatedExplicitVRLittleEndian,
+    "rle": RLELossless,
+    "jpeg-ls": JPEGLSLossless,
+    "jpeg2000": JPEG2000Lossless,
+}
+
+# Transfer syntaxes whose plugins are not thread-safe (pylibjpeg-openjpeg),
+# and which are thus encoded and decoded by one thread at a time
+_SERIAL = (JPEG2000Lossless, JPEG2000)
+
+_serial_lock = threading.Lock()
+
+
+def can_encode(uid):
+    """Check whether pixel data can be encoded with a transfer syntax (i.e.
+    whether the plugins it needs are installed)."""
+
+    if not uid.is_compressed:
+        return True
+    try:
+        return get_encoder(uid).is_available
+    except NotImplementedError:
+        return False
+
+
+def transfer_syntax_uid(transfer_syntax):
+    """Get the UID of an output transfer syntax.
+
+    Parameters
+    ----------
+    transfer_syntax : str or None
+        the name (see TRANSFER_SYNTAXES) or UID of the transfer syntax
+
+    Returns
+    -------
+    uid : pydicom.uid.UID or None
+        the UID (None if transfer_syntax is None)
+
+    Raises
+    ------
+    ValueError
+        if the transfer syntax is not supported, or cannot be encoded
+
+    """
+
+    if transfer_syntax is None:
+        return None
+    uid = TRANSFER_SYNTAXES.get(transfer_syntax, transfer_syntax)
+    if uid not in TRANSFER_SYNTAXES.values():
+        raise ValueError("Unknown transfer syntax '{0}' (must be one of "
+                         "{1})".format(transfer_syntax,
+                                       ", ".join(TRANSFER_SYNTAXES)))
+    uid = UID(uid)
+    if not can_encode(uid):
+        raise ValueError("Cannot encode {0}: pydicom misses the plugins for "
+                         "it (e.g. pyjpegls for JPEG-LS, or "
+                         "pylibjpeg-openjpeg for JPEG 2000)".format(uid.name))
+    return uid
+
+
+def _serial(uid):
+    """Get a lock for coding with a transfer syntax, if needed."""
+
+    if uid in _SERIAL:
+        return _serial_lock
+    return contextlib.nullcontext()
+
+
+def encode(d, uid, pixels=None):
+    """Set the transfer syntax of a dataset, encoding its pixel data.
+
+    Compressed pixel data is decoded first. The SOP Instance UID is kept,
+    as all transfer syntaxes are lossless. JPEG 2000 is encoded and decoded
+    by one thread at a time (use processes to encode it in parallel).
+
+    Parameters
+    ----------
+    d : pydicom.dataset.Dataset
+        the dataset (read with its pixel data, unless pixels are given)
+    uid : pydicom.uid.UID
+        the transfer syntax
+    pixels : numpy.ndarray, optional
+        if given, the new pixel data (stored values of all frames), which
+        replaces the pixel data of the dataset
+
+    """
+
+    current = d.file_meta.get("TransferSyntaxUID")
+    instance_uid = d.get("SOPInstanceUID")
+    if pixels is None and "PixelData" in d and current is not None and \
+            current.is_compressed and current != uid:
+        with _serial(current):
+            d.decompress()
+    elif pixels is not None:
+        d.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        d.add_new(0x7FE00010, "OB" if d.BitsAllocated == 8 else "OW",
+                  pixels.tobytes())
+    if uid.is_compressed and "PixelData" in d and \
+            d.file_meta.TransferSyntaxUID != uid:
+        with _serial(uid):
+            d.compress(uid)
+    else:
+        d.file_meta.TransferSyntaxUID = uid
+    if instance_uid is not None:  # pydicom>=3 generates a new one
+        d.SOPInstanceUID = instance_uid
+        d.file_meta.MediaStorageSOPInstanceUID = instance_uid
@@ -0,0 +1,110 @@
+"""Writing of output files.
+
+"""
+
+
+import io
+import os
+import shutil
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# Linux ioctl for cloning the extents of a file (btrfs, XFS, ...)
+_FICLONE = 0x40049409
+
+_TMP_SUFFIX = ".tmp_pseudicom"
+
+
+def save_dataset(d, path, contents_hash=None):
+    """Atomically save a dataset, via a temporary file that is renamed.
+
+    Parameters
+    ----------
+    d : pydicom.dataset.Dataset
+        the dataset
+    path : str
+        the file to write
+    contents_hash : hash object, optional
+        if given, updated with the contents of the file while writing it
+        (see pseudicom._manifest.new_hash)
+
+    """
+
+    tmp_file = path + _TMP_SUFFIX
+    try:
+        if contents_hash is None:
+            d.save_as(tmp_file)
+        else:
+            out = io.BytesIO()
+            d.save_as(out)
+            contents_hash.update(out.getbuffer())
+            with open(tmp_file, "wb") as f:
+                f.write(out.getbuffer())
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, path)
+
+
+def _reflink(src, dst):
+    """Create dst as a copy-on-write clone of src."""
+
+    if fcntl is None:
+        raise OSError("Reflinks are not supported")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+
+
+def link_or_copy(src, dst):
+    """Atomically create dst with the contents of (unchanged) src.
+
+    The cheapest method available is used: a reflink, a hardlink (on the
+    same filesystem), or a copy. Files created this way must only ever be
+    replaced (e.g. with save_dataset), and not modified in place, as a
+    hardlink shares its contents with src.
+
+    Parameters
+    ----------
+    src : str
+        the file to link or copy
+    dst : str
+        the file to create (an existing file is replaced)
+
+    """
+
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_file = dst + _TMP_SUFFIX
+    if os.path.lexists(tmp_file):
+        os.remove(tmp_file)
+    try:
+        try:
+            _reflink(src, tmp_file)
+            shutil.copystat(src, tmp_file)
+        except OSError:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            try:
+                os.link(src, tmp_file)
+            except OSError:
+                shutil.copy2(src, tmp_file)
+        os.replace(tmp_file, dst)
+    except Exception:
+        if os.path.lexists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def is_same_file(src, dst):
+    """Check whether dst is an (unchanged) link or copy of src."""
+
+    try:
+        s = os.stat(src)
+        d = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return os.path.samestat(s, d) or \
+        (s.st_size, s.st_mtime_ns) == (d.st_size, d.st_mtime_ns)
@@ -0,0 +1,54 @@
+"""Nipype interfaces of the workflow nodes (which measure their resource
+usage).
+
+Kept apart from the workflow, such that Nipype and its interfaces are only
+imported once a workflow is built.
+
+"""
+
+
+from nipype.pipeline import engine as pe
+from nipype.interfaces import utility, fsl, quickshear
+from nipype.interfaces.base import traits, InputMultiPath
+
+from ._profiling import Profiled
+
+
+class MapNode(pe.MapNode):
+    """A MapNode that runs no iterations (and has empty outputs) if its
+    iterfields are empty lists, instead of failing (e.g. if none of the
+    anatomy runs can be defaced)."""
+
+    def _create_dynamic_traits(self, basetraits, fields=None, nitems=None):
+        output = super()._create_dynamic_traits(basetraits, fields, nitems)
+        if fields is None or nitems is not None:
+            return output
+        # InputMultiPath turns empty lists into Undefined
+        for name in fields:
+            value = getattr(output, name)
+            output.remove_trait(name)
+            output.add_trait(name, traits.Either(
+                traits.List(), InputMultiPath(
+                    basetraits.traits()[name].trait_type)))
+            setattr(output, name, value)
+        return output
+
+    def _collate_results(self, nodes):
+        nodes = list(nodes)
+        result = super()._collate_results(nodes)
+        if not nodes and self.outputs:
+            for name in self.outputs.dictcopy():
+                setattr(result.outputs, name, [])
+        return result
+
+
+class Function(Profiled, utility.Function):
+    pass
+
+
+class BET(Profiled, fsl.BET):
+    pass
+
+
+class Quickshear(Profiled, quickshear.Quickshear):
+    pass
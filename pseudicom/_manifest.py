@@ -0,0 +1,382 @@
+"""Manifest of the processed DICOM files of a session.
+
+The manifest is a JSON-lines file within the (output) session directory, to
+which a record is appended whenever a file has been processed. Later records
+of a file update the earlier ones.
+
+Anonymized files are recorded ahead of replacing them (write-ahead): the
+record describes the new contents, such that a run that was interrupted
+before a file was replaced finds the file not to match its record (and
+processes it again), whereas a file that was replaced is current, and is
+never processed twice. Defaced files are recorded ahead as well, along with
+their anonymized (undefaced) contents, such that a file that was not replaced
+is defaced again, but not anonymized again.
+
+"""
+
+
+import os
+import json
+import hashlib
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+MANIFEST_DIR = ".pseudicom"
+MANIFEST_FILE = "manifest.jsonl"
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def new_hash():
+    """Create a hash object of the kind that the manifest records."""
+
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_hash(path):
+    """Get the hash of the contents of a file."""
+
+    h = new_hash()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _unchanged(path, size, mtime_ns, contents_hash, stat=None):
+    """Check whether a file still has the recorded stat (or else contents)."""
+
+    if stat is None:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        stat = (st.st_size, st.st_mtime_ns)
+    if stat == (size, mtime_ns):
+        return True
+    return file_hash(path) == contents_hash
+
+
+class Manifest:
+    """The manifest of a session.
+
+    Parameters
+    ----------
+    session_dir : str
+        the session directory (containing the processed files)
+    source_dir : str, optional
+        the session directory containing the source files, if the files are
+        not processed in place
+
+    """
+
+    def __init__(self, session_dir, source_dir=None):
+        self.session_dir = session_dir
+        self.source_dir = source_dir or session_dir
+        self.path = os.path.join(session_dir, MANIFEST_DIR, MANIFEST_FILE)
+
+    @property
+    def out_of_place(self):
+        return self.source_dir != self.session_dir
+
+    def load(self):
+        """Load the records of all files.
+
+        Returns
+        -------
+        records : dict
+            the (merged) record of each file, by path relative to the session
+            directory (or by the path of its source file relative to the
+            source directory, if the files are not processed in place)
+
+        """
+
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # incomplete line of an interrupted write
+                    continue
+                records.setdefault(record["file"], {}).update(record)
+        if self.out_of_place:
+            records = {r["source"]: r for r in records.values()
+                       if "source" in r}
+        return records
+
+    def record(self, path, from_file=None, contents_hash=None, **fields):
+        """Create a record of the current state of a file.
+
+        Parameters
+        ----------
+        path : str
+            the file
+        from_file : str, optional
+            the file that holds the contents of path for now (i.e.
+            a temporary file that is about to replace it, keeping its
+            modification time)
+        contents_hash : str, optional
+            the hash of the contents (see new_hash), if it was computed
+            while writing the file (such that it is not read again)
+        **fields
+            further fields of the record (e.g. stage="anonymized")
+
+        Returns
+        -------
+        record : dict
+            the record
+
+        """
+
+        st = os.stat(from_file or path)
+        record = {"file": os.path.relpath(path, self.session_dir),
+                  "output_hash": contents_hash or file_hash(from_file or path),
+                  "size": st.st_size,
+                  "mtime_ns": st.st_mtime_ns,
+                  "undefaced": None}
+        record.update(fields)
+        return record
+
+    def undefaced(self, path, records):
+        """Create the field of a record that describes the current
+        (anonymized) contents of a file that is about to be replaced with its
+        defaced version.
+
+        Parameters
+        ----------
+        path : str
+            the (current) file
+        records : dict
+            the records of all files (see load)
+
+        Returns
+        -------
+        fields : dict
+            the fields
+
+        """
+
+        st = os.stat(path)
+        record = records.get(os.path.relpath(path, self.session_dir), {})
+        if (st.st_size, st.st_mtime_ns) == (record.get("size"),
+                                            record.get("mtime_ns")):
+            contents_hash = record["output_hash"]
+        else:
+            contents_hash = file_hash(path)
+        return {"undefaced": {"output_hash": contents_hash,
+                              "size": st.st_size,
+                              "mtime_ns": st.st_mtime_ns}}
+
+    def update(self, path, records, **fields):
+        """Create a record that adds fields to the record of a file.
+
+        Parameters
+        ----------
+        path : str
+            the file
+        records : dict
+            the records of all files (see load)
+        **fields
+            the fields to add (e.g. stage="not_defaceable")
+
+        Returns
+        -------
+        record : dict
+            the record (a full record, see record, if the file does not have
+            the recorded size and modification time)
+
+        """
+
+        key = os.path.relpath(path, self.session_dir)
+        st = os.stat(path)
+        record = records.get(key, {})
+        if (st.st_size, st.st_mtime_ns) != (record.get("size"),
+                                            record.get("mtime_ns")):
+            return self.record(path, **fields)
+        record = {"file": key}
+        record.update(fields)
+        return record
+
+    def source(self, path, contents_hash=None):
+        """Create the fields of a record that describe the source file.
+
+        Parameters
+        ----------
+        path : str
+            the source file (before processing it)
+        contents_hash : str, optional
+            the hash of its contents (see new_hash), if it was computed
+            while reading the file (such that it is not read again)
+
+        Returns
+        -------
+        fields : dict
+            the fields
+
+        """
+
+        st = os.stat(path)
+        return {"source": os.path.relpath(path, self.source_dir),
+                "source_hash": contents_hash or file_hash(path),
+                "source_size": st.st_size,
+                "source_mtime_ns": st.st_mtime_ns}
+
+    def output_of(self, path, records):
+        """Get the processed file of a (current) file.
+
+        Parameters
+        ----------
+        path : str
+            the file (the source file, if the files are not processed in
+            place)
+        records : dict
+            the records of all files (see load)
+
+        Returns
+        -------
+        out_file : str
+            the processed file
+
+        """
+
+        if not self.out_of_place:
+            return path
+        record = records[os.path.relpath(path, self.source_dir)]
+        return os.path.join(self.session_dir, record["file"])
+
+    def renamed_outputs(self, records, settings, paths):
+        """Find the files that were processed in place under a new name
+        (as their name contained a date).
+
+        Only the processed files of the given source files are checked.
+
+        Parameters
+        ----------
+        records : dict
+            the records of all files (see load)
+        settings : str
+            the fingerprint of the anonymization settings
+        paths : list
+            the source files
+
+        Returns
+        -------
+        renamed : dict
+            the processed file of each source file, with the record of the
+            processed file, for the processed files that are current
+
+        """
+
+        renamed = {}
+        if self.out_of_place:
+            return renamed
+        sources = {os.path.relpath(path, self.source_dir): path
+                   for path in paths}
+        for record in records.values():
+            source = record.get("source")
+            if source not in sources or source == record["file"] or \
+                    record.get("settings") != settings:
+                continue
+            path = os.path.join(self.session_dir, record["file"])
+            if _unchanged(path, record["size"], record["mtime_ns"],
+                          record["output_hash"]):
+                renamed[sources[source]] = (path, record)
+        return renamed
+
+    def is_source_of(self, path, record):
+        """Check whether a file is (unchanged) the source file of a record."""
+
+        return _unchanged(path, record.get("source_size"),
+                          record.get("source_mtime_ns"),
+                          record.get("source_hash"))
+
+    def append(self, records):
+        """Append records to the manifest.
+
+        The records are written while holding a lock on the manifest (which
+        also holds on NFS, unlike appending alone, when the workers run on
+        several cluster nodes), and are flushed to disk before returning,
+        such that a file is only ever replaced after its record is stored.
+        A record that an interrupted write left incomplete is terminated
+        first, such that it does not corrupt the next one.
+
+        Parameters
+        ----------
+        records : list
+            the records to append
+
+        """
+
+        if not records:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = "".join(json.dumps(r, sort_keys=True) + "\n" for r in records)
+        data = data.encode()
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size:
+                os.lseek(fd, -1, os.SEEK_END)
+                if os.read(fd, 1) != b"\n":
+                    data = b"\n" + data
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)  # releases the lock
+
+    def is_current(self, path, records, settings, deface_settings=None,
+                   stat=None):
+        """Check whether a file has already been processed.
+
+        Parameters
+        ----------
+        path : str
+            the file (the source file, if the files are not processed in
+            place)
+        records : dict
+            the records of all files (see load)
+        settings : str
+            the fingerprint of the anonymization settings
+        deface_settings : str, optional
+            the fingerprint of the defacing settings, if the file needs to be
+            defaced
+        stat : tuple, optional
+            the (size, mtime_ns) of the file, if already known
+
+        Returns
+        -------
+        current : bool
+            True if the file has been processed with the same settings and
+            has not changed since
+
+        """
+
+        record = records.get(os.path.relpath(path, self.source_dir))
+        if record is None or record.get("settings") != settings:
+            return False
+        if deface_settings is not None and \
+                record.get("deface_settings") != deface_settings:
+            return False
+        if self.out_of_place:
+            if not _unchanged(path, record.get("source_size"),
+                              record.get("source_mtime_ns"),
+                              record.get("source_hash"), stat):
+                return False
+            path = os.path.join(self.session_dir, record["file"])
+            stat = None
+        if _unchanged(path, record["size"], record["mtime_ns"],
+                      record["output_hash"], stat):
+            return True
+        # A file that an interrupted run did not replace with its defaced
+        # version (yet) is still anonymized
+        undefaced = record.get("undefaced")
+        return deface_settings is None and undefaced is not None and \
+            _unchanged(path, undefaced["size"], undefaced["mtime_ns"],
+                       undefaced["output_hash"], stat)
@@ -0,0 +1,237 @@
+"""Compiled anonymization rules.
+
+"""
+
+
+import re
+import hashlib
+import datetime
+
+from pydicom.tag import Tag
+from pydicom.dataelem import RawDataElement
+from pydicom.multival import MultiValue
+from pydicom.uid import UID_dictionary
+
+
+_TAG_PATTERN = re.compile(
+    r"^\(\s*([0-9a-fA-F]{4})\s*,\s*([0-9a-fA-F]{4})\s*\)$")
+
+# Values that might be a date (DA: "YYYYMMDD", or ACR-NEMA "YYYY.MM.DD")
+_DATE_PATTERN = re.compile(r"^\d{4}\.?\d{2}\.?\d{2}$")
+
+
+def _parse_tag(tag):
+    """Convert a tag (e.g. "(0010, 0010)", 0x00100010 or "PatientName")
+    into an integer."""
+
+    if isinstance(tag, str):
+        match = _TAG_PATTERN.match(tag.strip())
+        if match:
+            return int(match.group(1) + match.group(2), 16)
+    return int(Tag(tag))
+
+
+def _replace_dates(value, dates):
+    """Replace the first of dates occurring in value with its replacement."""
+
+    value = str(value)
+    for date, new_date in dates.items():
+        if date in value:
+            return value.replace(date, new_date)
+    return value
+
+
+def _handle_date(d, tag, element, dates, deferred):
+    """DA: remember the date and replace it."""
+
+    element = d[tag]
+    if isinstance(element.value, str) and element.value:
+        if element.value not in dates:
+            dates.append(element.value)
+        deferred.append((element, _replace_dates))
+
+
+def _handle_date_containing(d, tag, element, dates, deferred):
+    """DT, UI: replace the dates contained in the value."""
+
+    element = d[tag]
+    if element.value:
+        deferred.append((element, _replace_dates))
+
+
+def _handle_other(d, tag, element, dates, deferred):
+    """Any other VR: replace the value if it equals a date."""
+
+    if isinstance(element, RawDataElement):
+        if element.length not in (8, 10):  # cannot be a date
+            return
+        element = d[tag]
+    value = element.value
+    if isinstance(value, str) and _DATE_PATTERN.match(value):
+        deferred.append((element, _replace_equal_date))
+
+
+def _replace_equal_date(value, dates):
+    """Replace value with its replacement if it equals one of dates."""
+
+    return dates.get(str(value), value)
+
+
+_NO_DATES = ("OB", "OD", "OF", "OL", "OV", "OW", "UN", "SQ")
+
+
+class AnonymizationProfile:
+    """Anonymization rules, compiled for applying them to many datasets.
+
+    Parameters
+    ----------
+    tags_to_clear : list
+        a list of DICOM tags (as strings, e.g. "(0010, 0010)", integers or
+        keywords) to clear
+    change_dates : bool or str, optional
+        if True, all dates will be changed to the current date; if a string
+        is given, all dates will be changed to that string (with pseudonyms,
+        dates are shifted by the date offset of the subject instead, unless
+        change_dates is False)
+    remove_private : bool, optional
+        if True, remove private tags
+    pseudonyms : pseudicom.PseudonymMap, optional
+        if given, replace all UIDs (except for the UIDs defined by the DICOM
+        standard, e.g. of SOP classes) with their pseudonyms, and shift the
+        dates (and optionally replace the PatientID, unless it is cleared)
+
+    """
+
+    def __init__(self, tags_to_clear, change_dates=True, remove_private=True,
+                 pseudonyms=None):
+        self.tags_to_clear = frozenset(_parse_tag(t) for t in tags_to_clear)
+        self.pseudonyms = pseudonyms
+        self.shift_dates = pseudonyms is not None and change_dates is not False
+        if self.shift_dates:
+            self.new_date = None
+        elif change_dates is True:
+            self.new_date = datetime.datetime.now().strftime("%Y%m%d")
+        else:
+            self.new_date = change_dates or None
+        self.remove_private = remove_private
+        self._today = change_dates is True and not self.shift_dates
+        self._handlers = dict.fromkeys(("DA", "DT", "UI") + _NO_DATES)
+        self._default_handler = None
+        if self.new_date or self.shift_dates:
+            self._handlers.update(DA=_handle_date,
+                                  DT=_handle_date_containing,
+                                  UI=_handle_date_containing)
+            self._default_handler = _handle_other
+        if pseudonyms is not None:
+            self._handlers["UI"] = self._handle_uid
+
+    def __repr__(self):
+        # Deterministic, as Nipype hashes node inputs by their repr
+        return "{0}(tags_to_clear=[{1}], new_date={2!r}, " \
+               "remove_private={3!r}, pseudonyms={4!r}, " \
+               "shift_dates={5!r})".format(
+                   type(self).__name__,
+                   ", ".join("0x{0:08X}".format(t)
+                             for t in sorted(self.tags_to_clear)),
+                   self.new_date, self.remove_private, self.pseudonyms,
+                   self.shift_dates)
+
+    @property
+    def fingerprint(self):
+        """A hash of the rules, which does not change with the current date
+        for change_dates=True."""
+
+        rules = repr(self)
+        if self._today:
+            rules = rules.replace(repr(self.new_date), "'today'")
+        return hashlib.sha1(rules.encode()).hexdigest()
+
+    def _replace_uid(self, value, dates):
+        """Replace a (non-standard) UID with its pseudonym."""
+
+        if isinstance(value, MultiValue):
+            return [self._replace_uid(v, dates) for v in value]
+        if value in UID_dictionary:
+            return value
+        return self.pseudonyms.uid(str(value))
+
+    def _handle_uid(self, d, tag, element, dates, deferred):
+        """UI (with pseudonyms): replace the UID."""
+
+        element = d[tag]
+        if element.value:
+            deferred.append((element, self._replace_uid))
+
+    def apply(self, d):
+        """Anonymize a dataset in place.
+
+        The dataset and all items of its sequences (at any depth) are walked
+        iteratively, and each element is visited once and only converted from
+        its raw form if it might need to be changed; values that depend on all
+        dates of the dataset (e.g. UIDs containing a date) are replaced at the
+        end.
+
+        Parameters
+        ----------
+        d : pydicom.dataset.Dataset
+            the dataset to anonymize
+
+        Returns
+        -------
+        dates : dict
+            the (original) dates found in the dataset, mapped to their
+            replacements (empty if dates are not changed)
+
+        """
+
+        subject = str(d.get("PatientID") or "")
+        dates = []
+        deferred = []
+        private = []
+        stack = [d]
+        while stack:
+            dataset = stack.pop()
+            for tag in list(dataset.keys()):
+                if self.remove_private and tag.is_private:
+                    private.append((dataset, tag))
+                    continue
+                element = dataset.get_item(tag)
+                vr = element.VR
+                if vr is None:  # raw element of an implicit VR dataset
+                    element = dataset[tag]
+                    vr = element.VR
+                if tag in self.tags_to_clear:
+                    element = dataset[tag]
+                    if vr == "DA" and isinstance(element.value, str) \
+                            and element.value and element.value not in dates:
+                        dates.append(element.value)
+                    element.value = ""
+                    continue
+                if vr == "SQ":
+                    # Reversed, such that items are visited in order
+                    stack.extend(reversed(dataset[tag].value))
+                    continue
+                handler = self._handlers.get(vr, self._default_handler)
+                if handler is not None:
+                    handler(dataset, tag, element, dates, deferred)
+        for dataset, tag in private:
+            del dataset[tag]
+        if self.shift_dates:
+            dates = {date: self.pseudonyms.shift_date(date, subject)
+                     for date in dates}
+        elif self.new_date:
+            dates = dict.fromkeys(dates, self.new_date)
+        else:
+            dates = {}
+        for element, replace in deferred:
+            element.value = replace(element.value, dates)
+        if self.pseudonyms is not None:
+            if self.pseudonyms.patient_ids and d.get("PatientID") and \
+                    0x00100020 not in self.tags_to_clear:
+                d.PatientID = self.pseudonyms.patient_id(subject)
+            file_meta = getattr(d, "file_meta", None)
+            if file_meta is not None and \
+                    file_meta.get("MediaStorageSOPInstanceUID"):
+                file_meta.MediaStorageSOPInstanceUID = self._replace_uid(
+                    file_meta.MediaStorageSOPInstanceUID, dates)
+        return dates
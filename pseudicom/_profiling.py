@@ -0,0 +1,266 @@
+"""Measurement of the resource usage of workflow nodes.
+
+"""
+
+
+import os
+import sys
+import json
+import time
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Inputs of the nodes that hold the files processed by an iteration
+_FILE_INPUTS = {
+    "anonymize": "in_files",
+    "dcm2nii": "in_files",
+    "bet": "in_file",
+    "deface": "in_file",
+    "nii2dcm": "dcm_files",
+}
+
+# ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def _read_io():
+    """Get the bytes read and written by this process (and its waited-for
+    children)."""
+
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":") for line in f)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of this process (Linux)."""
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """Get the peak resident set size (in bytes) of this process."""
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+
+def _children_usage():
+    """Get the CPU time and peak resident set size of the waited-for child
+    processes (e.g. of external programs)."""
+
+    if resource is None:
+        return 0.0, 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * _MAXRSS_UNIT
+
+
+class Usage:
+    """Measure the resource usage of a block of code (context manager).
+
+    The result holds the "start" and "end" (seconds since the epoch),
+    "wall_time" and "cpu_time" (in seconds, including child processes),
+    "peak_rss_mb" (the peak resident set size in MB, of this process or of
+    a child process), "bytes_read" and "bytes_written" (through system
+    calls, i.e. without memory-mapped files; Linux only), and "pid".
+
+    The peak resident set size is exact on Linux (where it can be reset);
+    elsewhere, and for child processes, it is the peak since the start of
+    the process, if it was reached within the block.
+
+    """
+
+    def __enter__(self):
+        self._exact_rss = _reset_peak_rss()
+        self._rss = _peak_rss()
+        self._children = _children_usage()
+        self._io = _read_io()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        self._start = time.time()
+        self.result = None
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_time = time.perf_counter() - self._wall
+        cpu_time = time.process_time() - self._cpu
+        children_cpu, children_rss = _children_usage()
+        cpu_time += children_cpu - self._children[0]
+        rss = _peak_rss()
+        if rss is not None and not self._exact_rss and rss <= self._rss:
+            rss = None  # reached before
+        if children_rss > self._children[1]:
+            rss = max(rss or 0, children_rss)
+        io = _read_io()
+        self.result = {
+            "start": self._start,
+            "end": self._start + wall_time,
+            "wall_time": wall_time,
+            "cpu_time": cpu_time,
+            "peak_rss_mb": rss / 1024 ** 2 if rss is not None else None,
+            "bytes_read": io[0] - self._io[0] if io and self._io else None,
+            "bytes_written": io[1] - self._io[1] if io and self._io
+            else None,
+            "pid": os.getpid(),
+        }
+        return False
+
+
+class Profiled:
+    """Mixin for Nipype interfaces that measures the resource usage of each
+    run, and stores it as "usage" in the runtime of the result."""
+
+    def _run_interface(self, runtime, *args, **kwargs):
+        with Usage() as usage:
+            runtime = super()._run_interface(runtime, *args, **kwargs)
+        runtime.usage = usage.result
+        return runtime
+
+
+def _n_files(value):
+    """Count the files of an input (a file, a list of files, or a run
+    directory with a list of file names)."""
+
+    if isinstance(value, tuple):
+        value = value[1]
+    if isinstance(value, (list, tuple)):
+        return len(value)
+    return 1 if isinstance(value, str) else None
+
+
+def node_usage(node, since):
+    """Get the usage of each iteration of a finished node.
+
+    Parameters
+    ----------
+    node : nipype.pipeline.engine.Node
+        the node (or MapNode)
+    since : float
+        the start of the run (seconds since the epoch); iterations that
+        started before (i.e. cached results) are left out
+
+    Returns
+    -------
+    iterations : list
+        the usage of each iteration (see Usage), with the "stage" (the name
+        of the node), "iteration" (None for a Node) and "files" (the number
+        of files it processed, if known)
+
+    """
+
+    runtimes = node.result.runtime
+    is_mapnode = isinstance(runtimes, list)
+    if not is_mapnode:
+        runtimes = [runtimes]
+    files = None
+    name = _FILE_INPUTS.get(node.name)
+    if name is not None:
+        files = getattr(node.inputs, name, None)
+        if not is_mapnode or not isinstance(files, list):
+            files = [files]
+    iterations = []
+    for c, runtime in enumerate(runtimes):
+        usage = getattr(runtime, "usage", None) if runtime else None
+        if usage is None or usage["start"] < since:
+            continue
+        entry = dict(usage, stage=node.name,
+                     iteration=c if is_mapnode else None, files=None)
+        if files is not None and c < len(files):
+            entry["files"] = _n_files(files[c])
+        iterations.append(entry)
+    return iterations
+
+
+def summarize(iterations):
+    """Summarize the usage of the iterations per stage.
+
+    Parameters
+    ----------
+    iterations : list
+        the usage of the iterations (see node_usage)
+
+    Returns
+    -------
+    stages : dict
+        for each stage, the number of "iterations", their total
+        "wall_time", "cpu_time", "bytes_read", "bytes_written" and "files",
+        the largest "peak_rss_mb", the "files_per_second" (per worker, None
+        if the files of the stage are not counted) and
+        the "elapsed" time from the first start to the last end
+
+    """
+
+    stages = {}
+    for entry in iterations:
+        stage = stages.setdefault(entry["stage"], {
+            "iterations": 0, "wall_time": 0.0, "cpu_time": 0.0,
+            "peak_rss_mb": None, "bytes_read": 0, "bytes_written": 0,
+            "files": None, "start": entry["start"], "end": entry["end"]})
+        stage["iterations"] += 1
+        for key in ("wall_time", "cpu_time", "bytes_read", "bytes_written"):
+            stage[key] += entry[key] or 0
+        if entry["files"] is not None:
+            stage["files"] = (stage["files"] or 0) + entry["files"]
+        if entry["peak_rss_mb"] is not None:
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"] or 0,
+                                       entry["peak_rss_mb"])
+        stage["start"] = min(stage["start"], entry["start"])
+        stage["end"] = max(stage["end"], entry["end"])
+    for stage in stages.values():
+        stage["files_per_second"] = stage["files"] / stage["wall_time"] \
+            if stage["files"] is not None and stage["wall_time"] else None
+        stage["elapsed"] = stage.pop("end") - stage.pop("start")
+    return stages
+
+
+def write_trace(report, trace_file):
+    """Write the iterations of a report as a Chrome trace (JSON) file.
+
+    Each session is a process, and each worker process a thread of the
+    trace, which can be viewed in chrome://tracing or Perfetto.
+
+    Parameters
+    ----------
+    report : dict
+        the per-session report (see pseudonimize_dicoms)
+    trace_file : str
+        the file to write
+
+    """
+
+    events = []
+    for c, (session, status) in enumerate(sorted(report.items())):
+        events.append({"name": "process_name", "ph": "M", "pid": c,
+                       "args": {"name": session}})
+        for entry in status["profile"]["iterations"]:
+            name = entry["stage"]
+            if entry["iteration"] is not None:
+                name = "{0}[{1}]".format(name, entry["iteration"])
+            events.append({
+                "name": name, "cat": entry["stage"], "ph": "X", "pid": c,
+                "tid": entry["pid"], "ts": entry["start"] * 1e6,
+                "dur": entry["wall_time"] * 1e6,
+                "args": {key: entry[key] for key in (
+                    "cpu_time", "peak_rss_mb", "bytes_read",
+                    "bytes_written", "files")}})
+    with open(trace_file, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
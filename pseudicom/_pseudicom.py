@@ -6,22 +6,745 @@ Pseudonimize DICOM images.
 
 
 import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import logging
 
-from nipype.pipeline import engine as pe
-from nipype.interfaces import utility as niu
-from nipype.interfaces.io import DataFinder
-from nipype.interfaces.dcm2nii import Dcm2niix
-from nipype.interfaces.fsl import BET, maths, utils
-from nipype.interfaces.quickshear import Quickshear
+from ._profile import AnonymizationProfile
+from ._manifest import Manifest
+from ._series import SeriesIndex
+from ._scan import scan_session
+from ._files import link_or_copy, is_same_file
+from ._encoding import transfer_syntax_uid
+from ._profiling import Usage, node_usage, summarize, write_trace
+
+
+_logger = logging.getLogger(__name__)
+
+# Estimated peak memory (in GB) and number of processes per MapNode
+# iteration, used by the scheduler to pack jobs
+_RESOURCES = {
+    "anonymize": (0.5, 1),
+    "dcm2nii": (1.0, 1),
+    "bet": (1.5, 1),
+    "deface": (1.0, 1),
+    "deface_native": (1.5, 1),
+    "nii2dcm": (1.0, 1),
+}
+
+# DICOM to NIfTI converters
+_CONVERTERS = ("dcm2niix", "native")
+
+# Defacers, with the fingerprint of the defacing settings, as recorded in
+# the manifest
+_DEFACE_SETTINGS = {
+    "bet": "{converter}+bet+quickshear",
+    "native": "{converter}+native-quickshear",
+}
+
+# Node-level arguments for batch-system plugins, filled with the estimates
+_CLUSTER_ARGS = {
+    "SLURM": ("sbatch_args", "--mem={mem_mb}M --cpus-per-task={n_procs}"),
+    "SLURMGraph": ("sbatch_args", "--mem={mem_mb}M --cpus-per-task={n_procs}"),
+    "SGE": ("qsub_args", "-l h_vmem={mem_mb}M"),
+    "SGEGraph": ("qsub_args", "-l h_vmem={mem_mb}M"),
+    "PBS": ("qsub_args", "-l procs={n_procs},mem={mem_mb}mb"),
+    "PBSGraph": ("qsub_args", "-l procs={n_procs},mem={mem_mb}mb"),
+}
+
+
+def _resources(name):
+    """Get the memory/CPU estimates of a node as Node keyword arguments."""
+
+    mem_gb, n_procs = _RESOURCES[name]
+    return {"mem_gb": mem_gb, "n_procs": n_procs}
+
+
+def _set_plugin_args(node, plugin):
+    """Pass the memory/CPU estimates of a node on to a batch system."""
+
+    if plugin in _CLUSTER_ARGS:
+        key, template = _CLUSTER_ARGS[plugin]
+        node.plugin_args = {key: template.format(
+                                mem_mb=int(node.mem_gb * 1024),
+                                n_procs=node.n_procs),
+                            "overwrite": False}
+
+
+class _SessionStatus:
+    """Collect the execution status of workflow nodes per session.
+
+    Used as the "status_callback" of the Nipype execution plugin, and fed
+    directly with the runs that are anonymized without Nipype.
+
+    """
+
+    def __init__(self, sessions):
+        self._sessions = sessions
+        self._workflows = {}
+        self._processed = set()
+        self.failed_nodes = {s: [] for s in sessions}
+        self.errors = {s: [] for s in sessions}
+        self.slices_written = {s: 0 for s in sessions}
+        self.slices_skipped = {s: 0 for s in sessions}
+        self.bytes_saved = {s: {} for s in sessions}
+        self.iterations = {s: [] for s in sessions}
+        self.started = time.time()
+
+    def add_workflow(self, name, session):
+        self._workflows[name] = session
+        self._processed.add(session)
+
+    def add_run(self, session, run_dir, errors, bytes_saved, usage,
+                failure=None):
+        """Add a run that was anonymized without Nipype."""
+
+        self._processed.add(session)
+        if failure is not None:
+            self.failed_nodes[session].append(failure)
+        self.errors[session].extend(errors)
+        self._add_bytes_saved(session, run_dir, session, bytes_saved)
+        self.iterations[session].append(usage)
+
+    def _add_bytes_saved(self, session, run_dir, session_dir, n):
+        # Series are identified by their run directory within the (input or
+        # output) session directory
+        series = os.path.relpath(run_dir, session_dir)
+        saved = self.bytes_saved[session]
+        saved[series] = saved.get(series, 0) + (n or 0)
+
+    def __call__(self, node, status):
+        # Errors must not reach the execution plugin, where they would replace
+        # the errors of the workflow
+        try:
+            self._update(node, status)
+        except Exception as e:
+            _logger.warning("Could not collect the status of %s: %s",
+                            node.fullname, e)
+
+    def _ran(self, node):
+        """Check whether a node has a result of this run (the Linear plugin
+        reports the nodes it skipped after a failure as ended, which have no
+        result, or a stale one in a retained working directory)."""
+
+        result_file = os.path.join(node.output_dir(),
+                                   "result_{0}.pklz".format(node.name))
+        try:
+            return os.path.getmtime(result_file) >= self.started
+        except OSError:
+            return False
+
+    def _update(self, node, status):
+        from nipype.interfaces.base import isdefined
+        if status == "exception":
+            for session in self._session_of(node):
+                self.failed_nodes[session].append(node.itername)
+            return
+        if status != "end" or not self._ran(node):
+            return
+        if node.name == "anonymize" and isdefined(node.inputs.in_path):
+            outputs = node.result.outputs
+            errors = [e for errors in outputs.errors if errors for e in errors]
+            for session in self._session_of(node):
+                self.errors[session].extend(errors)
+                for run_dir, n in zip(node.inputs.in_path,
+                                      outputs.bytes_saved):
+                    self._add_bytes_saved(session, run_dir, session, n)
+        elif node.name == "nii2dcm" and isdefined(node.inputs.dcm_files):
+            outputs = node.result.outputs
+            for session in self._session_of(node):
+                self.slices_written[session] += sum(
+                    n for n in outputs.n_written if n)
+                self.slices_skipped[session] += sum(
+                    n for n in outputs.n_skipped if n)
+                for (run_dir, names), n in zip(node.inputs.dcm_files,
+                                               outputs.bytes_saved):
+                    self._add_bytes_saved(session, run_dir,
+                                          node.inputs.session, n)
+        # MapNode iterations are collected from the runtimes of their parent
+        # (which are only reported as nodes of their own by some plugins)
+        if "mapflow" not in node.output_dir():
+            iterations = node_usage(node, self.started)
+            for session in self._session_of(node):
+                self.iterations[session].extend(iterations)
+
+    def _session_of(self, node):
+        # MapNode iterations are placed within the directory of their parent,
+        # which is within the directory of the session workflow
+        parts = node.output_dir().split(os.sep)
+        return [self._workflows[p] for p in parts if p in self._workflows]
+
+    def report(self):
+        # A file that could not be anonymized fails the session, as it is
+        # left as it was
+        return {s: {"succeeded": not self.failed_nodes[s] and
+                                 not self.errors[s],
+                    "up_to_date": s not in self._processed,
+                    "failed_nodes": self.failed_nodes[s],
+                    "errors": self.errors[s],
+                    "slices_written": self.slices_written[s],
+                    "slices_skipped": self.slices_skipped[s],
+                    "bytes_saved": self.bytes_saved[s],
+                    "profile": {
+                        "stages": summarize(self.iterations[s]),
+                        "iterations": self.iterations[s]}}
+                for s in self._sessions}
+
+
+def _default_work_dir():
+    """Get the persistent working directory (in the user's cache)."""
+
+    cache = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "pseudicom")
+
+
+def _session_name(directory):
+    """Get the name of the workflow of a session, which is the same for
+    the same session directory across runs (such that an interrupted run
+    can resume from the results in the working directory)."""
+
+    digest = hashlib.blake2b(directory.encode("utf-8"), digest_size=6)
+    return "session_" + digest.hexdigest()
+
+
+def _write_report(report, report_file, trace_file):
+    """Write the report as JSON, and its profile as a Chrome trace."""
+
+    if report_file is not None:
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=2)
+    if trace_file is not None:
+        write_trace(report, trace_file)
+
+
+def _mirror_session(index, directory, out_dir):
+    """Link (or copy) all files of a session that are not processed (i.e.
+    that are not DICOM files or backups) into an output directory."""
+
+    for src in index.other_files:
+        dst = os.path.join(out_dir, os.path.relpath(src.path, directory))
+        if not is_same_file(src.path, dst):
+            link_or_copy(src.path, dst)
+
+
+def _plan_session(index, directory, anatomy_keywords, settings,
+                  deface_settings, out_dir=None):
+    """Find the runs of a session that (still) need to be processed.
+
+    Runs of which all DICOM files have been anonymized (and defaced, for
+    anatomy runs, or found not to be defaceable, e.g. localizers) with the
+    same settings, according to the manifest of the (output) session, are
+    skipped.
+
+    Returns
+    -------
+    runs : list
+        (run directory, DICOM file names) of each run to process
+    anats : list
+        the indices of the anatomy runs within runs
+
+    """
+
+    manifest = Manifest(out_dir or directory, directory)
+    records = manifest.load()
+    series = SeriesIndex(out_dir or directory, directory)
+    series.load()
+    runs = []
+    anats = []
+    for run_dir, dicoms in index.runs.items():
+        if anatomy_keywords is None:
+            is_anat = series.describe(run_dir, dicoms)["anatomical"]
+        else:
+            is_anat = any(keyword in run_dir for keyword in anatomy_keywords)
+        if all(manifest.is_current(f.path, records, settings,
+                                   deface_settings if is_anat else None,
+                                   stat=(f.size, f.mtime_ns))
+               for f in dicoms):
+            continue
+        if is_anat:
+            anats.append(len(runs))
+        runs.append((run_dir, [os.path.basename(f.path) for f in dicoms]))
+    series.save()
+    return runs, anats
+
+
+# Anonymize DICOMs (MapNode)
+#
+# Files that are modified in place are passed by name (relative to their run
+# directory) rather than by path, as Nipype would otherwise hash them by their
+# timestamp and run the node again once they have been modified.
+def _anonymize(in_path, in_files, session, out_session, make_backup, profile,
+               header_only, n_workers, pool, transfer_syntax):
+    import os
+    import logging
+    from pseudicom._anonymize import anonymize_files
+    from pseudicom._manifest import Manifest
+    in_files = [os.path.join(in_path, f) for f in in_files]
+    out_path = None
+    if out_session is not None:
+        out_path = os.path.join(out_session,
+                                os.path.relpath(in_path, session))
+    out_files, errors, bytes_saved = anonymize_files(
+        in_files, make_backup, profile, header_only=header_only,
+        n_workers=n_workers, pool=pool,
+        manifest=Manifest(out_session or session, session), out_dir=out_path,
+        transfer_syntax=transfer_syntax)
+    for error in errors:
+        logging.getLogger("nipype.workflow").warning(
+            "Could not anonymize %s", error)
+    return out_path or in_path, [os.path.basename(f) for f in out_files
+                                 if f is not None], errors, bytes_saved
+
+
+# Select anatomy runs (Node)
+def _find_anats(in_paths, in_files, indices):
+    import os
+    return [[os.path.join(in_paths[c], f) for f in in_files[c]]
+            for c in indices]
+
+
+# Convert DICOM to NIfTI (MapNode)
+#
+# Multi-frame series are always assembled natively (from the pixel array of
+# their frames), as the write-back needs to know the frame of each slice.
+def _dcm2nii(in_files, converter):
+    import os
+    import json
+    import nibabel as nb
+    import pydicom
+    from nipype.interfaces.base import isdefined
+    from nipype.interfaces.dcm2nii import Dcm2niix
+    from pseudicom._volume import load_series, is_multiframe
+    if converter == "dcm2niix" and not is_multiframe(
+            pydicom.dcmread(in_files[0], stop_before_pixels=True)):
+        result = Dcm2niix(source_names=in_files, args="-x i -i y",
+                          output_dir=os.getcwd()).run()
+        out_file = result.outputs.converted_files
+        if isinstance(out_file, list):
+            out_file = out_file[0] if out_file else None
+        if not isdefined(out_file):  # derived, localizer or 2D images
+            out_file = None
+        return out_file, None
+    try:
+        data, affine, slices, scaling = load_series(in_files)
+    except ValueError:  # derived, localizer or 2D images
+        return None, None
+    name = os.path.basename(os.path.dirname(in_files[0]))
+    out_file = os.path.abspath(name + ".nii")
+    img = nb.Nifti1Image(data, affine)
+    img.header.set_slope_inter(*scaling)
+    nb.save(img, out_file)
+    index_file = os.path.abspath(name + "_index.json")
+    with open(index_file, "w") as f:
+        json.dump({"files": [os.path.basename(x) for x, frame in slices],
+                   "frames": [frame for x, frame in slices]}, f)
+    return out_file, index_file
+
+
+# Remove derived, localizer and 2D images
+#
+# The runs that are removed are recorded in the manifest as done (with the
+# defacing settings), such that they are not planned for defacing again.
+def _remove_derived(in_files, nii_files, index_files=None, session=None,
+                    deface_settings=None):
+    import traits
+    from pseudicom._manifest import Manifest
+    in_files_out = []
+    nii_files_out = []
+    index_files_out = []
+    dropped = []
+    if index_files is None:  # dcm2niix
+        index_files = [None] * len(nii_files)
+    len_diff = len(in_files) - len(nii_files)
+    if len_diff > 0:  # dcm2niix removes <undefined> at the beginning of the outputs list!
+        dropped.extend(in_files[:len_diff])
+        in_files = in_files[len_diff:]
+    for c,x in enumerate(nii_files):
+        if x is not None and type(x) != traits.trait_base._Undefined:
+            in_files_out.append(in_files[c])
+            nii_files_out.append(x)
+            index_files_out.append(index_files[c])
+        else:
+            dropped.append(in_files[c])
+    if session is not None:
+        manifest = Manifest(session)
+        records = manifest.load()
+        manifest.append([manifest.update(f, records, stage="not_defaceable",
+                                         deface_settings=deface_settings)
+                         for files in dropped for f in files])
+    return in_files_out, nii_files_out, index_files_out
+
+
+# Deface NIfTI with the built-in defacer (MapNode)
+#
+# The stored values are defaced, and saved with the original scaling.
+def _deface_native(in_file):
+    import os
+    import numpy as np
+    import nibabel as nb
+    from pseudicom._deface import deface
+    img = nb.load(in_file)
+    data = np.array(img.dataobj.get_unscaled())
+    slope, intercept = img.dataobj.slope, img.dataobj.inter
+    fill = -intercept / slope
+    if data.dtype.kind in "iu":
+        info = np.iinfo(data.dtype)
+        fill = np.clip(np.rint(fill), info.min, info.max)
+    deface(data, img.affine, fill=fill)
+    defaced = img.__class__(data, img.affine, img.header)
+    defaced.header.set_slope_inter(slope, intercept)
+    out_file = os.path.abspath(
+        os.path.basename(in_file).replace(".nii", "_defaced.nii"))
+    nb.save(defaced, out_file)
+    return out_file
+
+
+# Convert NiFTI to DICOM (MapNode)
+#
+# The stored values of the volumes are read at once (reading a slice of
+# a gzipped NIfTI file decompresses it from the start; the uncompressed files
+# of the native converter are memory-mapped), and scaled slice by slice. Each
+# slice is written back in the pixel format of its DICOM file (or frame of
+# a multi-frame file), which is placed by the slice index of the native
+# converter, or else by its InstanceNumber (dcm2niix flips the slice order
+# and rotates the slices).
+# Slices that defacing did not change (i.e. that are equal to those of the
+# original volume) are not written back, and the changed frames of
+# a multi-frame file are written back at once, in the transfer syntax of the
+# file where possible. The defaced files are written to temporary files, and
+# recorded in the manifest before they replace the files (see
+# pseudicom._manifest).
+def _nii2dcm(in_file, orig_file, dcm_files, index_file, make_backup, session,
+             deface_settings):
+    from nipype import logging
+    import os
+    import json
+    import numpy as np
+    import nibabel as nb
+    import pydicom
+    from pseudicom._manifest import Manifest, new_hash
+    from pseudicom._files import link_or_copy
+    from pseudicom._volume import (to_stored_values, slice_rescale,
+                                   pixel_dtype, save_pixels)
+    run_dir, names = dcm_files
+    headers = {}
+    for name in names:
+        f = os.path.join(run_dir, name)
+        headers[f] = pydicom.dcmread(f, stop_before_pixels=True)
+    proxy = nb.load(in_file).dataobj
+    orig_proxy = nb.load(orig_file).dataobj
+    data = proxy.get_unscaled()
+    orig_data = orig_proxy.get_unscaled()
+    n_slices = data.shape[2]
+    if index_file is not None:  # native converter
+        with open(index_file) as f:
+            index = json.load(f)
+        index = [(os.path.join(run_dir, name), frame)
+                 for name, frame in zip(index["files"],
+                                        index.get("frames") or
+                                        [None] * len(index["files"]))]
+        orient = np.transpose
+    else:
+        index = [None] * n_slices
+        for f, d in headers.items():
+            k = n_slices - int(d.InstanceNumber)
+            if not 0 <= k < n_slices:
+                raise ValueError("{0}: InstanceNumber {1} out of range".format(
+                    f, d.InstanceNumber))
+            index[k] = (f, None)
+        orient = np.rot90
+
+    def scaled(proxy, values, k):
+        values = np.asarray(values[:, :, k])
+        if (proxy.slope, proxy.inter) != (1.0, 0.0):
+            values = values * proxy.slope + proxy.inter
+        return values
+
+    written = {}  # the temporary file and its hash of each file
+
+    def write(f, d, pixels):
+        contents_hash = new_hash()
+        save_pixels(d, f + ".tmp_deface", pixels, contents_hash)
+        written[f] = (f + ".tmp_deface", contents_hash.hexdigest())
+
+    n_written = 0
+    n_skipped = 0
+    bytes_saved = 0
+    changed_frames = {}
+    try:
+        for k, entry in enumerate(index):
+            if entry is None:
+                continue
+            f, frame = entry
+            d = headers[f]
+            if (np.array_equal(data[:, :, k], orig_data[:, :, k]) and
+                    (proxy.slope, proxy.inter) ==
+                    (orig_proxy.slope, orig_proxy.inter)):
+                n_skipped += 1
+                continue
+            rescale = slice_rescale(d, frame)
+            stored = to_stored_values(orient(scaled(proxy, data, k)), d,
+                                      rescale)
+            orig_stored = to_stored_values(
+                orient(scaled(orig_proxy, orig_data, k)), d, rescale)
+            if np.array_equal(stored, orig_stored):
+                n_skipped += 1
+                continue
+            n_written += 1
+            if frame is None:
+                write(f, d, stored)
+            else:
+                changed_frames.setdefault(f, {})[frame] = stored
+        for f, frames in changed_frames.items():
+            d = pydicom.dcmread(f)
+            pixels = d.pixel_array.astype(pixel_dtype(d))
+            for frame, stored in frames.items():
+                pixels[frame] = stored
+            write(f, d, pixels)
+
+        # Record all files (the unchanged ones as they are) before replacing
+        # any of them
+        manifest = Manifest(session)
+        records = manifest.load()
+        files = sorted(set(entry[0] for entry in index if entry is not None))
+        manifest.append([
+            manifest.record(f, from_file=written[f][0],
+                            contents_hash=written[f][1], stage="defaced",
+                            deface_settings=deface_settings,
+                            **manifest.undefaced(f, records))
+            if f in written else
+            manifest.update(f, records, stage="defaced",
+                            deface_settings=deface_settings)
+            for f in files])
+    except Exception:
+        for tmp_file, contents_hash in written.values():
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        raise
+    for f, (tmp_file, contents_hash) in written.items():
+        if make_backup and not os.path.exists(f + ".bak_deface"):
+            link_or_copy(f, f + ".bak_deface")
+        bytes_saved += os.path.getsize(f) - os.path.getsize(tmp_file)
+        os.replace(tmp_file, f)
+    logging.getLogger("nipype.workflow").info(
+        "Defaced %d slices of %s (%d unchanged)", n_written, run_dir,
+        n_skipped)
+    return files, n_written, n_skipped, bytes_saved
+
+
+# Helper functions
+def _fix_defaced_outfile(niis):
+    import os
+    return [os.path.split(nii)[-1].replace(".nii", "_defaced.nii") \
+            for nii in niis]
+
+
+def _split_runs(runs):
+    import os
+    return [(os.path.dirname(files[0]), [os.path.basename(f) for f in files])
+            for files in runs]
+
+
+def _anonymize_runs(directory, out_dir, runs, profile, make_backup,
+                    header_only, anonymize_workers, anonymize_pool,
+                    transfer_syntax, status):
+    """Anonymize the runs of a single session directly, without Nipype."""
+
+    for c, (run_dir, dicoms) in enumerate(runs):
+        errors = []
+        bytes_saved = 0
+        failure = None
+        with Usage() as usage:
+            try:
+                out_path, out_files, errors, bytes_saved = _anonymize(
+                    run_dir, dicoms, directory, out_dir, make_backup,
+                    profile, header_only, anonymize_workers, anonymize_pool,
+                    transfer_syntax)
+            except Exception as e:
+                failure = "anonymize {0}: {1}".format(run_dir, e)
+        status.add_run(directory, run_dir, errors, bytes_saved,
+                       dict(usage.result, stage="anonymize", iteration=c,
+                            files=len(dicoms)),
+                       failure)
+
+
+def _session_workflow(name, directory, out_dir, runs, anats, profile,
+                      make_backup, header_only, anonymize_workers,
+                      anonymize_pool, transfer_syntax, converter, defacer,
+                      plugin):
+    """Create the workflow to process the runs of a single session."""
+
+    from nipype.pipeline import engine as pe
+    from ._interfaces import MapNode, Function, BET, Quickshear
+
+    session_wf = pe.Workflow(name)
+
+    anonymize = pe.MapNode(Function(input_names=["in_path", "in_files",
+                                                "session", "out_session",
+                                                "make_backup", "profile",
+                                                "header_only",
+                                                "n_workers", "pool",
+                                                "transfer_syntax"],
+                                    output_names=["out_path",
+                                                  "out_files", "errors",
+                                                  "bytes_saved"],
+                                    function=_anonymize),
+                         iterfield=["in_path", "in_files"],
+                         name="anonymize",
+                         **_resources("anonymize"))
+    anonymize.inputs.in_path = [run_dir for run_dir, dicoms in runs]
+    anonymize.inputs.in_files = [dicoms for run_dir, dicoms in runs]
+    anonymize.inputs.session = directory
+    anonymize.inputs.out_session = out_dir
+    anonymize.inputs.make_backup = make_backup
+    anonymize.inputs.profile = profile
+    anonymize.inputs.header_only = header_only
+    anonymize.inputs.n_workers = anonymize_workers
+    anonymize.inputs.pool = anonymize_pool
+    anonymize.inputs.transfer_syntax = transfer_syntax
+    if anonymize_pool == "process":
+        anonymize.n_procs = anonymize_workers
+    # Keep the (unconnected) errors and bytes saved for the report
+    anonymize.config = {"execution": {"remove_unnecessary_outputs": False}}
+    _set_plugin_args(anonymize, plugin)
+    session_wf.add_nodes([anonymize])
+    if not anats:
+        return session_wf
+    deface_settings = _DEFACE_SETTINGS[defacer].format(converter=converter)
+
+    find_anats = pe.Node(Function(input_names=["in_paths", "in_files",
+                                               "indices"],
+                                  output_names=["out_files"],
+                                  function=_find_anats),
+                         name="find_anats")
+    find_anats.inputs.indices = anats
+
+    remove_derived = pe.Node(Function(input_names=["in_files",
+                                                   "nii_files",
+                                                   "index_files",
+                                                   "session",
+                                                   "deface_settings"],
+                                      output_names=["out_files",
+                                                    "nii_files",
+                                                    "index_files"],
+                                      function=_remove_derived),
+                             name="remove_derived")
+    remove_derived.inputs.session = out_dir or directory
+    remove_derived.inputs.deface_settings = deface_settings
+
+    # Convert DICOM to NIfTI (MapNode)
+    dcm2nii = pe.MapNode(Function(input_names=["in_files", "converter"],
+                                  output_names=["converted_files",
+                                                "index_file"],
+                                  function=_dcm2nii),
+                         name="dcm2nii", iterfield=["in_files"],
+                         **_resources("dcm2nii"))
+    dcm2nii.inputs.converter = converter
+    _set_plugin_args(dcm2nii, plugin)
+
+    # Deface NIfTI (MapNode, which runs no iterations if all anatomy runs
+    # were removed)
+    if defacer == "native":
+        deface = MapNode(Function(input_names=["in_file"],
+                                  output_names=["out_file"],
+                                  function=_deface_native),
+                         name='deface', iterfield=["in_file"],
+                         **_resources("deface_native"))
+    else:
+        bet = MapNode(BET(mask=True), name='bet', iterfield=["in_file"],
+                      **_resources("bet"))
+        deface = MapNode(Quickshear(), name='deface',
+                         iterfield=["in_file", "mask_file", "out_file"],
+                         **_resources("deface"))
+        _set_plugin_args(bet, plugin)
+        session_wf.connect([
+            (remove_derived, bet, [('nii_files', 'in_file')]),
+            (remove_derived, deface,
+             [(('nii_files', _fix_defaced_outfile), 'out_file')]),
+            (bet, deface, [('mask_file', 'mask_file')]),
+            ])
+    _set_plugin_args(deface, plugin)
+
+    nii2dcm = MapNode(Function(input_names=['in_file', 'orig_file',
+                                            'dcm_files', 'index_file',
+                                            'make_backup', 'session',
+                                            'deface_settings'],
+                               output_names=['out_files', 'n_written',
+                                             'n_skipped', 'bytes_saved'],
+                               function=_nii2dcm),
+                      name='nii2dcm',
+                      iterfield=["in_file", "orig_file", "dcm_files",
+                                 "index_file"],
+                      **_resources("nii2dcm"))
+    nii2dcm.inputs.make_backup = make_backup
+    nii2dcm.inputs.session = out_dir or directory
+    nii2dcm.inputs.deface_settings = deface_settings
+    # Keep the (unconnected) slice counts and bytes saved for the report
+    nii2dcm.config = {"execution": {"remove_unnecessary_outputs": False}}
+    _set_plugin_args(nii2dcm, plugin)
+
+    session_wf.connect([
+        (anonymize, find_anats, [('out_path', 'in_paths'),
+                                 ('out_files', 'in_files')]),
+        (find_anats, dcm2nii, [('out_files', 'in_files')]),
+        (find_anats, remove_derived, [('out_files', 'in_files')]),
+        (dcm2nii, remove_derived, [('converted_files', 'nii_files'),
+                                   ('index_file', 'index_files')]),
+        (remove_derived, deface, [('nii_files', 'in_file')]),
+        (deface, nii2dcm, [('out_file', 'in_file')]),
+        (remove_derived, nii2dcm, [('nii_files', 'orig_file')]),
+        (remove_derived, nii2dcm,
+         [(('out_files', _split_runs), 'dcm_files'),
+          ('index_files', 'index_file')]),
+        ])
+    return session_wf
+
+
+def pseudonimize_study(root, session_pattern="sub*/ses-mri*", **kwargs):
+    """Pseudonimize DICOM images of all sessions within a study directory.
+
+    All sessions are processed within one single workflow, sharing the same
+    scheduler and pool of workers.
+
+    Parameters
+    ----------
+    root : str
+        the study directory
+    session_pattern : str, optional
+        a glob pattern (relative to root) that specifies the session
+        directories
+        Default:
+            "sub*/ses-mri*"
+    **kwargs
+        further arguments for pseudonimize_dicoms (an output_dir mirrors the
+        layout of the study directory)
+
+    Returns
+    -------
+    report : dict
+        the per-session report (see pseudonimize_dicoms)
+
+    """
+
+    sessions = sorted(d for d in glob.glob(os.path.join(root, session_pattern))
+                      if os.path.isdir(d))
+    if not sessions:
+        raise ValueError("No sessions matching '{0}' found in '{1}'".format(
+            session_pattern, root))
+    if isinstance(kwargs.get("output_dir"), str):
+        kwargs["output_dir"] = [
+            os.path.join(kwargs["output_dir"], os.path.relpath(s, root))
+            for s in sessions]
+    return pseudonimize_dicoms(sessions, **kwargs)
 
 
 def pseudonimize_dicoms(directory,
                         run_dir_pattern="[0-9][0-9][0-9]-.+",
-                        anatomy_keywords=[
-                            "t1", "T1",
-                            "mprage", "MPRAGE",
-                            "AAHead"
-                        ],
+                        anatomy_keywords=None,
                         tags_to_clear=[
                             "(0007, 002a)",  # Acquisition DateTime
                             "(0008, 0012)",  # Instance Creation Date
@@ -172,7 +895,21 @@ def pseudonimize_dicoms(directory,
                         change_dates=True,
                         remove_private=True,
                         make_backup=True,
-                        work_dir=None):
+                        work_dir=None,
+                        plugin="MultiProc",
+                        n_procs=None,
+                        plugin_args=None,
+                        header_only=False,
+                        anonymize_workers=1,
+                        anonymize_pool="thread",
+                        output_dir=None,
+                        converter="dcm2niix",
+                        defacer="bet",
+                        pseudonyms=None,
+                        deface=True,
+                        report_file=None,
+                        trace_file=None,
+                        transfer_syntax=None):
 
     """Psuedonimize DICOM images within a directory.
 
@@ -180,8 +917,21 @@ def pseudonimize_dicoms(directory,
     and potentially identifiable information) and (2) deface high-resolution
     anatomical DICOMS.
 
+    By default, files are processed in place. If an output directory is
+    given, the layout of the session directory is mirrored into it instead,
+    leaving the session directory untouched; files that are not processed
+    are hardlinked (or reflinked/copied) into the output directory.
+
+    Processed files are recorded in a manifest (".pseudicom/manifest.jsonl"
+    within the (output) session directory), such that re-running only
+    processes new or changed files, and files processed with different
+    settings.
+
     Parameters
     ----------
+    directory : str or list
+        the session directory, or a list of session directories to process
+        within one workflow
     run_dir_pattern : str, optional
         a regular expression that specifies the pattern to find run
         directories
@@ -190,12 +940,13 @@ def pseudonimize_dicoms(directory,
     anatomy_keywords : list, optional
         a list of keywords (as strings, e.g. "T1") that are part of the run
         directory name, if that run corresponnds to an anatomical recording
+        (e.g. ["t1", "T1", "mprage", "MPRAGE", "AAHead"]); if None, anatomical
+        runs (to be defaced) are detected from their DICOM header instead (3D
+        acquisitions with at least 64 slices and a voxel size of at most 2 mm
+        that are not derived), and cached in a series index
+        (".pseudicom/series.json" within the (output) session directory)
         Default:
-            [
-                "t1", "T1",
-                "mprage", "MPRAGE",
-                "AAHead"
-            ]
+            None
     tags_to_clear : list, optional
         a list of DICOM tags (as strings, e.g. "(0010, 0010)") to clear
         Default:
@@ -358,211 +1109,216 @@ def pseudonimize_dicoms(directory,
             True
     make_backup : bool, optional
         if True, make backups before both anonymizing ("*.bak_anynym") and
-        defacing ("*.bak_deface") in the same directory
+        defacing ("*.bak_deface") in the same directory (ignored if
+        output_dir is given)
         Default:
             True
     work_dir : str, optional
-        a working directory for the Nipype worklfow
+        a working directory for the Nipype worklfow, which holds
+        a directory per session (named after a hash of the session
+        directory), such that a run that was interrupted resumes from the
+        nodes that finished; None uses "pseudicom" in the user's cache
+        directory (e.g. "~/.cache/pseudicom"), and removes the directories
+        of the sessions that succeeded
+        Default:
+            None
+    plugin : str or None, optional
+        the Nipype execution plugin (e.g. "Linear", "MultiProc", "SLURM",
+        "SGE", "PBS"); None anonymizes sessions that need no defacing
+        directly in this process, without Nipype (and without a work
+        directory), running the files of a run in parallel with
+        anonymize_workers (sessions with anatomical images to deface are
+        run with the "Linear" plugin)
+        Default:
+            "MultiProc"
+    n_procs : int, optional
+        the maximal number of parallel processes when running with the
+        "MultiProc" plugin (None means all available cores)
+        Default:
+            None
+    plugin_args : dict, optional
+        additional arguments for the Nipype execution plugin (e.g.
+        {"sbatch_args": "--time=24:00:00"} for "SLURM")
+        Default:
+            None
+    header_only : bool, optional
+        if True, only read and rewrite the DICOM headers when anonymizing,
+        and copy the pixel data over as is (without decoding it)
+        Default:
+            False
+    anonymize_workers : int, optional
+        the number of files within a run directory to anonymize in parallel
+        Default:
+            1
+    anonymize_pool : str, optional
+        the kind of worker pool ("thread" or "process") to anonymize files
+        in parallel with
+        Default:
+            "thread"
+    output_dir : str or list, optional
+        the output directory to write the processed session to, instead of
+        processing the files in place; if a list of sessions is given, a list
+        of output directories (one per session)
+        Default:
+            None
+    converter : str, optional
+        how to convert anatomical DICOM series to NIfTI for defacing: with
+        "dcm2niix", or "native" (assembling the volume directly from the
+        DICOM slices, without running an external program); (enhanced)
+        multi-frame series are always converted natively
+        Default:
+            "dcm2niix"
+    defacer : str, optional
+        how to deface anatomical images: with "bet" (FSL's BET brain
+        extraction, followed by Quickshear), or "native" (a built-in
+        estimate of the brain mask, followed by the same shear plane as
+        Quickshear, without running an external program)
+        Default:
+            "bet"
+    pseudonyms : pseudicom.PseudonymMap, optional
+        a keyed mapping to consistent pseudonyms; if given, all UIDs are
+        replaced with their pseudonyms (keeping the references between
+        instances, series and studies), dates are shifted by a date offset
+        per subject (keeping the intervals between sessions; unless
+        change_dates is False), and PatientIDs are optionally replaced with
+        their pseudonyms
+        Default:
+            None
+    deface : bool, optional
+        if False, only anonymize, and leave anatomical images as they are
+        Default:
+            True
+    report_file : str, optional
+        if given, write the report (see below) to this JSON file
+        Default:
+            None
+    trace_file : str, optional
+        if given, write the profile of all sessions to this JSON file in the
+        Chrome trace format (to view the timeline of the stages in
+        chrome://tracing or https://ui.perfetto.dev)
+        Default:
+            None
+    transfer_syntax : str, optional
+        the (lossless) transfer syntax to write all anonymized files with,
+        to reduce their size: "explicit", "implicit" or "deflated" (explicit
+        VR little endian, compressed with zlib), "rle", "jpeg-ls" or
+        "jpeg2000" (the latter two need the pydicom plugins pyjpegls or
+        pylibjpeg-openjpeg), or its UID; by default, the transfer syntax of
+        each file is kept (defaced images are written back in the transfer
+        syntax of their file, or uncompressed if it cannot be encoded); the
+        files are encoded by the workers that anonymize them
         Default:
             None
 
-    """
+    Returns
+    -------
+    report : dict
+        the per-session report, with each session directory mapping to a dict
+        with the keys "succeeded" (bool, False if a node crashed or a file
+        could not be anonymized), "up_to_date" (bool, True if nothing
+        had to be processed), "failed_nodes" (list of the Nipype nodes, or runs
+        anonymized without Nipype, that crashed), "errors" (list of files that
+        could not be anonymized), "slices_written" and "slices_skipped" (number
+        of anatomical slices that were changed by defacing and written back,
+        and that were left unchanged), "bytes_saved" (the number of bytes by
+        which anonymizing and defacing reduced the size of each series, by
+        run directory), and "profile" (the resource usage of the
+        stages that ran: "iterations" lists the wall and CPU time, peak memory,
+        bytes read and written and number of files of each node and MapNode
+        iteration, and "stages" sums them up per stage); if a single session
+        directory is given, failures will raise a RuntimeError instead
 
-    pseudonimize_wf = pe.Workflow('pseudonimize_dicoms')
-    if work_dir is not None:
-        pseudonimize_wf.base_dir = work_dir
-
-    # Select all runs
-    def _find_runs(directory, run_dir_pattern):
-        import os
-        import re
-        out_paths = []
-        for root, dirs, files in os.walk(directory):
-            for d in dirs:
-                if re.search(run_dir_pattern, d):
-                    out_paths.append(os.path.join(root, d))
-        return sorted(out_paths)
-
-    find_runs = pe.Node(niu.Function(input_names=["directory",
-                                                  "run_dir_pattern"],
-                                     output_names=["out_paths"],
-                                     function=_find_runs),
-                        name="find_runs")
-    find_runs.inputs.directory  = os.path.abspath(directory)
-    find_runs.inputs.run_dir_pattern = run_dir_pattern
-
-    # Anonymize DICOMs (MapNode)
-    def _anonymize(in_path, make_backup, tags_to_clear, change_dates,
-                   remove_private):
-        import os
-        import glob
-        import datetime
-        import pydicom
-        dicoms = []
-        files = glob.glob(os.path.join(in_path, "*"))
-        for f in files:
-            if f.endswith("dcm") or f.endswith("IMA"):
-                dicoms.append(f)
-        if change_dates is True:
-          timestamp = datetime.datetime.now()
-          new_date = timestamp.strftime("%Y%m%d")
-        else:
-          new_date = change_dates
-        for f in files:
-            d = pydicom.dcmread(f)
-            if remove_private:
-                d.remove_private_tags()
-            dates = []
-            for element in d:
-                if element.VR == "DA":
-                    dates.append(element.value)
-            for element in d:
-                if str(element.tag) in tags_to_clear:
-                    element.value = ""
-                elif change_dates:
-                    if element.VR == "SQ":
-                        for s in element:
-                            for e in s:
-                                if e.VR in ("DA", "DT", "UI"):
-                                    for date in dates:
-                                        if date in str(e.value):
-                                            e.value = str(e.value).replace(
-                                                date, new_date)
-                                        break
-                                elif str(e.value) in dates:
-                                    e.value = new_date
-                    elif element.VR in ("DA", "DT", "UI"):
-                        for date in dates:
-                            if date in str(element.value):
-                                element.value = str(element.value).replace(
-                                    date, new_date)
-                                break
-                    elif str(element.value) in dates:
-                        element.value = new_date
-            try:
-              d.fix_meta_info()
-            except AttributeError:  # not needed anymore for pydicom>=3
-              pass
-            if make_backup:
-                os.rename(f, f + ".bak_anonym")
-            else:
-                os.remove(f)
-            path, name = os.path.split(f)
-            for date in dates:
-                if date in name:
-                    name = name.replace(date, new_date)
-                    break
-            d.save_as(os.path.join(path, name))
-        return in_path
-
-    anonymize = pe.MapNode(niu.Function(input_names=["in_path", "make_backup",
-                                                    "tags_to_clear",
-                                                    "change_dates",
-                                                    "remove_private"],
-                                        output_names=["out_path"],
-                                        function=_anonymize),
-                         iterfield=["in_path"],
-                         name="anonymize")
-    anonymize.inputs.make_backup = make_backup
-    anonymize.inputs.tags_to_clear = tags_to_clear
-    anonymize.inputs.change_dates = change_dates
-    anonymize.inputs.remove_private = remove_private
-
-    # Select anatomy runs (Node)
-    def _find_anats(in_paths, keywords):
-        import os
-        import glob
-        out_files = []
-        for path in in_paths:
-            for keyword in keywords:
-                if keyword in path:
-                    dicoms = []
-                    for files in ("*.dcm", "*.IMA"):
-                        dicoms.extend(glob.glob(os.path.join(path, files)))
-                    out_files.append(sorted(dicoms))
-                    break
-        return out_files
-
-    find_anats = pe.Node(niu.Function(input_names=["in_paths", "keywords"],
-                                      output_names=["out_files"],
-                                      function=_find_anats),
-                         name="find_anats")
-    find_anats.inputs.keywords = anatomy_keywords
+    """
 
-    # Convert DICOM to NIfTI (MapNode)
-    converter = pe.MapNode(
-        Dcm2niix(args= '-x i -i y'),
-        name="dcm2nii", iterfield=["source_names"])
-
-    # Remove derived, localizer and 2D images
-    def _remove_derived(in_files, nii_files):
-        import traits
-        in_files_out = []
-        nii_files_out = []
-        len_diff = len(in_files) - len(nii_files)
-        if len_diff > 0:  # dcm2niix removes <undefined> at the beginning of the outputs list!
-            in_files = in_files[len_diff:]
-        for c,x in enumerate(nii_files):
-            if type(x) != traits.trait_base._Undefined:
-                in_files_out.append(in_files[c])
-                nii_files_out.append(x)
-        return in_files_out, nii_files_out
-
-    remove_derived = pe.Node(niu.Function(input_names=["in_files",
-                                                       "nii_files"],
-                                          output_names=["out_files",
-                                                        "nii_files"],
-                                          function=_remove_derived),
-                             name="remove_derived")
+    if isinstance(directory, str):
+        sessions = [os.path.abspath(directory)]
+    else:
+        sessions = [os.path.abspath(d) for d in directory]
+    if converter not in _CONVERTERS:
+        raise ValueError("Unknown converter '{0}' (must be one of {1})".format(
+            converter, ", ".join(_CONVERTERS)))
+    if defacer not in _DEFACE_SETTINGS:
+        raise ValueError("Unknown defacer '{0}' (must be one of {1})".format(
+            defacer, ", ".join(_DEFACE_SETTINGS)))
+    deface_settings = _DEFACE_SETTINGS[defacer].format(converter=converter)
+    transfer_syntax = transfer_syntax_uid(transfer_syntax)
+    if output_dir is None:
+        out_dirs = [None] * len(sessions)
+    else:
+        if isinstance(output_dir, str):
+            output_dir = [output_dir]
+        if len(output_dir) != len(sessions):
+            raise ValueError("Number of output directories ({0}) does not "
+                             "match number of sessions ({1})".format(
+                                 len(output_dir), len(sessions)))
+        out_dirs = [os.path.abspath(d) for d in output_dir]
+        for session, out_dir in zip(sessions, out_dirs):
+            if out_dir == session or out_dir.startswith(session + os.sep):
+                raise ValueError("Output directory '{0}' is within session "
+                                 "directory '{1}'".format(out_dir, session))
+        make_backup = False
 
-    # Deface NIfTI (MapNode)
-    bet = pe.MapNode(BET(mask=True), name='bet', iterfield=["in_file"])
-    deface = pe.MapNode(Quickshear(), name='deface',
-                        iterfield=["in_file", "mask_file", "out_file"])
-
-    # Convert NiFTI to DICOM (MapNode)
-    def _nii2dcm(in_file, dcm_files, make_backup):
-        import numpy as np
-        import nibabel as nb
-        import pydicom
-        img = nb.load(in_file)
-        pixel_data = np.flip(img.get_fdata().astype(np.uint16), 2)
-        for f in dcm_files:
-            d = pydicom.dcmread(f)
-            slice_nr = int(d.InstanceNumber)
-            if make_backup:
-                d.save_as(f + ".bak_deface")
-            d.PixelData = np.rot90(pixel_data[:,:,slice_nr-1]).tobytes()
-            d.save_as(f)
-        return dcm_files
-
-    nii2dcm = pe.MapNode(niu.Function(input_names=['in_file', 'dcm_files',
-                                                   'make_backup'],
-                                      output_names=['out_files'],
-                                      function=_nii2dcm),
-                         name='nii2dcm', iterfield=["in_file", "dcm_files"])
-    nii2dcm.inputs.make_backup = make_backup
+    profile = AnonymizationProfile(tags_to_clear, change_dates,
+                                   remove_private, pseudonyms)
+    if not deface:
+        anatomy_keywords = []
+    status = _SessionStatus(sessions)
+    pseudonimize_wf = None
+    clean_up = work_dir is None
+    if clean_up:
+        work_dir = _default_work_dir()
+    for session, out_dir in zip(sessions, out_dirs):
+        index = scan_session(session, run_dir_pattern)
+        if out_dir is not None:
+            _mirror_session(index, session, out_dir)
+        runs, anats = _plan_session(index, session, anatomy_keywords,
+                                    profile.fingerprint, deface_settings,
+                                    out_dir)
+        if not runs:  # up to date
+            continue
+        if plugin is None and not anats:
+            _anonymize_runs(session, out_dir, runs, profile, make_backup,
+                            header_only, anonymize_workers, anonymize_pool,
+                            transfer_syntax, status)
+            continue
+        if pseudonimize_wf is None:
+            from nipype.pipeline import engine as pe
+            pseudonimize_wf = pe.Workflow('pseudonimize_dicoms')
+            pseudonimize_wf.base_dir = work_dir
+        session_wf = _session_workflow(_session_name(session), session,
+                                       out_dir, runs, anats, profile,
+                                       make_backup, header_only,
+                                       anonymize_workers, anonymize_pool,
+                                       transfer_syntax, converter, defacer,
+                                       plugin)
+        pseudonimize_wf.add_nodes([session_wf])
+        status.add_workflow(session_wf.name, session)
 
-    # Helper functions
-    def fix_defaced_outfile(niis):
-        import os
-        return [os.path.split(nii)[-1].replace(".nii", "_defaced.nii") \
-                for nii in niis]
-
-    # Connect everything and run
-    pseudonimize_wf.connect([
-        (find_runs, anonymize, [('out_paths', 'in_path')]),
-        (anonymize, find_anats, [('out_path', 'in_paths')]),
-        (find_anats, converter, [('out_files', 'source_names')]),
-        (find_anats, remove_derived, [('out_files', 'in_files')]),
-        (converter, remove_derived, [('converted_files', 'nii_files')]),
-        (remove_derived, bet, [('nii_files', 'in_file')]),
-        (remove_derived, deface, [('nii_files', 'in_file')]),
-        (remove_derived, deface,
-         [(('nii_files', fix_defaced_outfile), 'out_file')]),
-        (bet, deface, [('mask_file', 'mask_file')]),
-        (deface, nii2dcm, [('out_file', 'in_file')]),
-        (remove_derived, nii2dcm, [('out_files', 'dcm_files')]),
-        ])
+    if pseudonimize_wf is not None:
+        if plugin is None:
+            plugin = "Linear"
+        plugin_args = dict(plugin_args or {})
+        plugin_args.setdefault("status_callback", status)
+        if plugin == "MultiProc" and n_procs is not None:
+            plugin_args.setdefault("n_procs", n_procs)
+        try:
+            pseudonimize_wf.run(plugin=plugin, plugin_args=plugin_args)
+        except RuntimeError:
+            if isinstance(directory, str):
+                _write_report(status.report(), report_file, trace_file)
+                raise
 
-    pseudonimize_wf.run()
+    report = status.report()
+    _write_report(report, report_file, trace_file)
+    if clean_up and pseudonimize_wf is not None:
+        # The working directory holds intermediate (undefaced) images
+        for session, session_report in report.items():
+            if session_report["succeeded"]:
+                shutil.rmtree(os.path.join(work_dir, pseudonimize_wf.name,
+                                           _session_name(session)),
+                              ignore_errors=True)
+    if isinstance(directory, str) and not report[sessions[0]]["succeeded"]:
+        raise RuntimeError("Could not anonymize: {0}".format(
+            "; ".join(report[sessions[0]]["failed_nodes"] +
+                      report[sessions[0]]["errors"])))
+    return report
@@ -0,0 +1,292 @@
+"""Keyed, consistent pseudonyms of UIDs, dates and patient IDs.
+
+"""
+
+
+import os
+import hmac
+import sqlite3
+import hashlib
+import datetime
+import functools
+import threading
+import multiprocessing.util
+
+
+# Number of new pseudonyms after which they are written to the cache file
+_FLUSH_SIZE = 1000
+
+# The pseudonym maps of this process, by their settings (see _shared_map)
+_maps = {}
+_maps_lock = threading.Lock()
+
+
+def _shift_date(date, days):
+    """Shift a date ("YYYYMMDD", or ACR-NEMA "YYYY.MM.DD") by a number of
+    days, keeping its format ("" if it is not a valid date)."""
+
+    digits = date.replace(".", "")
+    try:
+        shifted = datetime.datetime.strptime(digits, "%Y%m%d").date() + \
+            datetime.timedelta(days=days)
+    except ValueError:
+        return ""
+    if "." in date:
+        return shifted.strftime("%Y.%m.%d")
+    return shifted.strftime("%Y%m%d")
+
+
+def _forget_maps():
+    """Forget the pseudonym maps of the parent process in a forked process,
+    which must open its own connections to the cache files."""
+
+    global _maps_lock
+    _maps.clear()
+    _maps_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_maps)
+
+
+def _shared_map(state):
+    """Unpickle a pseudonym map, reusing the map of this process with the
+    same settings (and thus its cache file connection and the pseudonyms in
+    memory), if any."""
+
+    with _maps_lock:
+        pseudonyms = _maps.get(_settings(state))
+        if pseudonyms is None:
+            pseudonyms = PseudonymMap.__new__(PseudonymMap)
+            pseudonyms.__dict__.update(state)
+            pseudonyms._init_cache()
+            _maps[_settings(state)] = pseudonyms
+    return pseudonyms
+
+
+def _settings(state):
+    cache_file = state["cache_file"]
+    return (state["key_id"],
+            None if cache_file is None else os.path.abspath(cache_file),
+            state["max_date_shift"], state["patient_ids"],
+            state["patient_id_prefix"], state["cache_size"])
+
+
+class PseudonymMap:
+    """A keyed mapping of identifiers to pseudonyms.
+
+    The pseudonyms are derived from the identifiers with an HMAC, such that
+    the same identifier is always mapped to the same pseudonym (across
+    sessions, studies and parallel workers), and the identifier cannot be
+    recovered without the key:
+
+    * UIDs are mapped to new, valid UIDs ("2.25.<128-bit integer>"), such
+      that references between instances and series stay intact
+    * each subject (by its original PatientID) gets a date offset of 1 to
+      max_date_shift days into the past, which keeps the intervals between
+      the sessions of a subject
+    * PatientIDs are (optionally) mapped to "<prefix><16 hex digits>"
+
+    Recently used pseudonyms are kept in memory; optionally, all pseudonyms
+    are also recorded in an SQLite cache file, which allows looking up the
+    original identifiers later (see original) and guards against using
+    a different key for the same data. The cache file (like the key)
+    re-identifies the data and must be kept private.
+
+    New pseudonyms are written to the cache file in batches (see flush),
+    and when the process exits. A map that is unpickled (e.g. in the
+    workers of a process pool, or in each Nipype node) is shared by all
+    unpickled copies within a process, which use a single connection to the
+    cache file. The cache file must be on a local disk: parallel processes
+    write to it in SQLite's WAL mode, which does not work on network file
+    systems (e.g. NFS). Jobs on several machines (e.g. of a cluster) must
+    thus not share a cache file, but can each use their own (the pseudonyms
+    only depend on the key).
+
+    Parameters
+    ----------
+    key : str or bytes
+        the secret key
+    cache_file : str, optional
+        the SQLite cache file (created if it does not exist)
+        Default:
+            None
+    max_date_shift : int, optional
+        the largest date offset (in days)
+        Default:
+            3650
+    patient_ids : bool, optional
+        if True, replace PatientIDs with their pseudonym
+        Default:
+            False
+    patient_id_prefix : str, optional
+        the prefix of PatientID pseudonyms
+        Default:
+            "sub-"
+    cache_size : int, optional
+        the number of pseudonyms kept in memory
+        Default:
+            65536
+
+    Raises
+    ------
+    ValueError
+        if the cache file was created with a different key
+
+    """
+
+    def __init__(self, key, cache_file=None, max_date_shift=3650,
+                 patient_ids=False, patient_id_prefix="sub-",
+                 cache_size=65536):
+        self._key = key.encode() if isinstance(key, str) else bytes(key)
+        self.cache_file = cache_file
+        self.max_date_shift = max_date_shift
+        self.patient_ids = patient_ids
+        self.patient_id_prefix = patient_id_prefix
+        self.cache_size = cache_size
+        self.key_id = self._digest("key", "").hex()[:16]
+        self._init_cache()
+        with _maps_lock:
+            _maps.setdefault(_settings(self.__dict__), self)
+
+    def __repr__(self):
+        # Deterministic, and without the key (see AnonymizationProfile)
+        return "{0}(key_id={1!r}, max_date_shift={2!r}, patient_ids={3!r}, " \
+               "patient_id_prefix={4!r})".format(
+                   type(self).__name__, self.key_id, self.max_date_shift,
+                   self.patient_ids, self.patient_id_prefix)
+
+    def __reduce__(self):
+        state = self.__dict__.copy()
+        for name in ("_lookup", "_lock", "_connection", "_pending"):
+            del state[name]
+        return _shared_map, (state,)
+
+    def _init_cache(self):
+        self._lookup = functools.lru_cache(self.cache_size)(self._pseudonym)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._connection = None
+        if self.cache_file is not None:
+            self._connection = self._connect()
+            # Also run in the workers of process pools (unlike atexit)
+            multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+
+    def _connect(self):
+        """Open (and initialize) the cache file."""
+
+        connection = sqlite3.connect(self.cache_file, timeout=60,
+                                     check_same_thread=False)
+        with connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS meta "
+                               "(name TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS pseudonyms "
+                               "(kind TEXT, original TEXT, pseudonym TEXT, "
+                               "PRIMARY KEY (kind, original)) WITHOUT ROWID")
+            connection.execute("CREATE INDEX IF NOT EXISTS reverse "
+                               "ON pseudonyms (kind, pseudonym)")
+            connection.execute("INSERT OR IGNORE INTO meta VALUES "
+                               "('key_id', ?)", (self.key_id,))
+        key_id, = connection.execute(
+            "SELECT value FROM meta WHERE name = 'key_id'").fetchone()
+        if key_id != self.key_id:
+            connection.close()
+            raise ValueError("Cache file '{0}' was created with a different "
+                             "key".format(self.cache_file))
+        return connection
+
+    def _digest(self, kind, value):
+        return hmac.new(self._key, "{0}\0{1}".format(kind, value).encode(),
+                        hashlib.sha256).digest()
+
+    def _pseudonym(self, kind, value):
+        """Derive the pseudonym of an identifier (see _lookup)."""
+
+        digest = self._digest(kind, value)
+        if kind == "uid":
+            pseudonym = "2.25.{0}".format(int.from_bytes(digest[:16], "big"))
+        elif kind == "date_offset":
+            pseudonym = str(-1 - int.from_bytes(digest[:8], "big") %
+                            self.max_date_shift)
+        else:
+            pseudonym = self.patient_id_prefix + digest.hex()[:16]
+        if self._connection is not None:
+            with self._lock:
+                self._pending.append((kind, value, pseudonym))
+                if len(self._pending) >= _FLUSH_SIZE:
+                    self._flush()
+        return pseudonym
+
+    def _flush(self):
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO pseudonyms VALUES (?, ?, ?)",
+                self._pending)
+        self._pending = []
+
+    def flush(self):
+        """Write new pseudonyms to the cache file (in a single
+        transaction)."""
+
+        if self._connection is not None:
+            with self._lock:
+                if self._pending:
+                    self._flush()
+
+    def close(self):
+        """Write new pseudonyms to, and close the cache file."""
+
+        if self._connection is not None:
+            self.flush()
+            self._connection.close()
+            self._connection = None
+        with _maps_lock:
+            if _maps.get(_settings(self.__dict__)) is self:
+                del _maps[_settings(self.__dict__)]
+
+    def uid(self, uid):
+        """Get the pseudonym of a UID."""
+
+        return self._lookup("uid", uid)
+
+    def date_offset(self, subject):
+        """Get the date offset (in days) of a subject (by PatientID)."""
+
+        return int(self._lookup("date_offset", subject))
+
+    def shift_date(self, date, subject):
+        """Shift a date by the date offset of a subject ("" if the date is
+        not valid)."""
+
+        return _shift_date(date, self.date_offset(subject))
+
+    def patient_id(self, patient_id):
+        """Get the pseudonym of a PatientID."""
+
+        return self._lookup("patient_id", patient_id)
+
+    def original(self, kind, pseudonym):
+        """Look up the original identifier of a pseudonym in the cache file.
+
+        Parameters
+        ----------
+        kind : str
+            the kind of pseudonym ("uid" or "patient_id")
+        pseudonym : str
+            the pseudonym
+
+        Returns
+        -------
+        original : str or None
+            the original identifier (None if it is not in the cache file)
+
+        """
+
+        if self._connection is None:
+            return None
+        self.flush()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT original FROM pseudonyms WHERE kind = ? AND "
+                "pseudonym = ?", (kind, pseudonym)).fetchone()
+        return row[0] if row else None
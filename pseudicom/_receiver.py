@@ -0,0 +1,508 @@
+"""DICOM receiver (Storage SCP) that anonymizes instances on arrival.
+
+Instances are anonymized in a pool of workers and written into an output
+tree of sessions (one per study) and run directories (one per series), which
+pseudonimize_dicoms can process. The storage of an instance is only
+confirmed to the sender once it has been written (so that instances of
+several associations are anonymized in parallel). Once no further instances
+of a series have arrived for a while, the series is complete, and anatomical
+series are queued for defacing. Complete (and defaced) series can be
+forwarded to another Storage SCP.
+
+"""
+
+
+import os
+import re
+import time
+import queue
+import inspect
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+try:
+    from pynetdicom import (AE, evt, AllStoragePresentationContexts,
+                            StoragePresentationContexts, ALL_TRANSFER_SYNTAXES)
+except ImportError:  # optional dependency
+    AE = None
+
+from ._profile import AnonymizationProfile
+from ._pseudonyms import PseudonymMap
+from ._anonymize import _anonymize
+from ._manifest import Manifest, new_hash
+from ._series import classify_series
+from ._files import save_dataset
+from ._pseudicom import pseudonimize_dicoms
+
+
+_STOP = object()
+
+# C-STORE statuses
+_SUCCESS = 0x0000
+_OUT_OF_RESOURCES = 0xA700
+_CANNOT_UNDERSTAND = 0xC000
+
+# Characters that are replaced in directory names
+_UNSAFE = re.compile(r"[^A-Za-z0-9._+-]+")
+
+_logger = logging.getLogger(__name__)
+
+
+def _safe_name(value, default):
+    return _UNSAFE.sub("_", str(value or "")).strip("_.") or default
+
+
+class _Series:
+    """The state of a series that is being received."""
+
+    def __init__(self):
+        self.pending = 0
+        self.last_arrival = time.monotonic()
+        self.files = []
+        self.errors = 0
+        self.session_dir = None
+        self.run_dir = None
+
+
+class DicomReceiver:
+    """A DICOM Storage SCP that anonymizes instances on arrival.
+
+    Parameters
+    ----------
+    output_dir : str
+        the directory to write the anonymized instances to, with a session
+        directory per study ("<StudyInstanceUID>", with its manifest, as
+        written by pseudonimize_dicoms), a run directory per series
+        ("<SeriesNumber>-<SeriesDescription>") and a file per instance
+        ("<SOPInstanceUID>.dcm")
+    port : int, optional
+        the port to listen on
+        Default:
+            11112
+    ae_title : str, optional
+        the AE title of the receiver
+        Default:
+            "PSEUDICOM"
+    address : str, optional
+        the address to listen on (all interfaces if empty)
+        Default:
+            ""
+    tags_to_clear, change_dates, remove_private, pseudonyms : optional
+        the anonymization rules (see pseudonimize_dicoms, with the same
+        defaults)
+    n_workers : int, optional
+        the number of instances to anonymize in parallel
+        Default:
+            4
+    queue_size : int, optional
+        the number of received instances that may be waiting for (or in)
+        anonymization; senders are held back while the queue is full
+        Default:
+            256
+    series_timeout : float, optional
+        the number of seconds after the last instance of a series arrived
+        after which the series is considered complete
+        Default:
+            30.0
+    deface : bool, optional
+        if True, deface complete anatomical series (detected from their
+        DICOM header) with pseudonimize_dicoms
+        Default:
+            True
+    deface_options : dict, optional
+        further arguments for pseudonimize_dicoms (e.g. "defacer",
+        "converter", "work_dir" or "plugin")
+        Default:
+            None
+    forward : tuple, optional
+        the (address, port, AE title) of a Storage SCP to forward complete
+        (and defaced) series to
+        Default:
+            None
+    report_interval : float, optional
+        the number of seconds between logged status reports (see stats)
+        Default:
+            60.0
+
+    """
+
+    def __init__(self, output_dir, port=11112, ae_title="PSEUDICOM",
+                 address="", tags_to_clear=None, change_dates=True,
+                 remove_private=True, n_workers=4, queue_size=256,
+                 series_timeout=30.0, deface=True, deface_options=None,
+                 forward=None, report_interval=60.0, pseudonyms=None):
+        if AE is None:
+            raise ImportError("The DICOM receiver requires pynetdicom")
+        if tags_to_clear is None:
+            tags_to_clear = inspect.signature(
+                pseudonimize_dicoms).parameters["tags_to_clear"].default
+        self.output_dir = os.path.abspath(output_dir)
+        self.port = port
+        self.ae_title = ae_title
+        self.address = address
+        self.n_workers = n_workers
+        self.series_timeout = series_timeout
+        self.deface = deface
+        self.forward = forward
+        self.report_interval = report_interval
+        self.profile = AnonymizationProfile(tags_to_clear, change_dates,
+                                            remove_private, pseudonyms)
+        self._deface_options = dict(deface_options or {})
+        self._deface_options.update(tags_to_clear=tags_to_clear,
+                                    change_dates=change_dates,
+                                    remove_private=remove_private,
+                                    pseudonyms=pseudonyms,
+                                    make_backup=False)
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._pool = None
+        self._deface_queue = queue.Queue()
+        self._forward_queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._series = {}
+        self._run_dirs = {}
+        self._counts = {"received": 0, "stored": 0, "failed": 0,
+                        "queue_depth": 0,
+                        "series_completed": 0, "series_defaced": 0,
+                        "deface_failures": 0, "forwarded": 0,
+                        "forward_failures": 0}
+        self._first_arrival = None
+        self._last_stored = None
+        self._stopping = threading.Event()
+        self._server = None
+        self._threads = []
+
+    def start(self):
+        """Start receiving (in the background)."""
+
+        ae = AE(ae_title=self.ae_title)
+        ae.maximum_associations = max(ae.maximum_associations,
+                                      self.n_workers)
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax,
+                                     ALL_TRANSFER_SYNTAXES)
+        self._pool = ThreadPoolExecutor(self.n_workers)
+        self._stopping.clear()
+        self._threads = [threading.Thread(target=target, daemon=True)
+                         for target in (self._deface_loop,
+                                        self._forward_loop,
+                                        self._monitor_loop)]
+        for thread in self._threads:
+            thread.start()
+        self._server = ae.start_server(
+            (self.address, self.port), block=False,
+            evt_handlers=[(evt.EVT_C_STORE, self._handle_store)])
+        _logger.info("Receiving on port %d as %s", self.port, self.ae_title)
+
+    def stop(self):
+        """Stop receiving, and finish processing all received instances
+        (all series are considered complete)."""
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        self._pool.shutdown()
+        deface, forward, monitor = self._threads
+        self._stopping.set()
+        monitor.join()
+        self._complete_series(timeout=0)
+        self._deface_queue.put(_STOP)
+        deface.join()
+        self._forward_queue.put(_STOP)
+        forward.join()
+        if self.profile.pseudonyms is not None:
+            self.profile.pseudonyms.flush()
+        _logger.info("Stopped: %s", self.stats())
+
+    def serve_forever(self):
+        """Receive until interrupted (e.g. with Ctrl+C)."""
+
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stats(self):
+        """Get the current status.
+
+        Returns
+        -------
+        stats : dict
+            the number of instances "received", "stored" (anonymized) and
+            "failed", the "instances_per_second" stored (between the first
+            arrival and the last stored instance), the "queue_depth"
+            (received instances waiting for or being anonymized), the number
+            of "open_series" and "series_completed", the
+            "deface_queue_depth" and number of
+            "series_defaced" (and "deface_failures"), and the number of
+            instances "forwarded" (and "forward_failures")
+
+        """
+
+        with self._lock:
+            stats = dict(self._counts)
+            stats["open_series"] = len(self._series)
+            elapsed = 0
+            if self._last_stored is not None:
+                elapsed = self._last_stored - self._first_arrival
+        stats["instances_per_second"] = \
+            stats["stored"] / elapsed if elapsed else 0.0
+        stats["deface_queue_depth"] = self._deface_queue.qsize()
+        return stats
+
+    def _handle_store(self, event):
+        """Store a received instance (EVT_C_STORE handler), and return its
+        status once it is written (or has failed)."""
+
+        d = event.dataset
+        d.file_meta = event.file_meta
+        uid = str(d.get("SeriesInstanceUID", ""))
+        self._slots.acquire()
+        with self._lock:
+            series = self._series.setdefault(uid, _Series())
+            series.pending += 1
+            series.last_arrival = time.monotonic()
+            if self._first_arrival is None:
+                self._first_arrival = series.last_arrival
+            self._counts["received"] += 1
+            self._counts["queue_depth"] += 1
+        future = self._pool.submit(self._store, uid, d)
+        future.add_done_callback(self._stored)
+        return future.result()[-1]
+
+    def _run_dir(self, d):
+        """Get the (session directory, run directory) of an anonymized
+        instance."""
+
+        session_dir = os.path.join(
+            self.output_dir, _safe_name(d.get("StudyInstanceUID"), "study"))
+        key = (session_dir, str(d.get("SeriesInstanceUID", "")))
+        with self._lock:
+            run_dir = self._run_dirs.get(key)
+            if run_dir is None:
+                name = "{0:03d}-{1}".format(
+                    int(d.get("SeriesNumber") or 0),
+                    _safe_name(d.get("SeriesDescription"), "series"))
+                run_dir = os.path.join(session_dir, name)
+                taken = set(self._run_dirs.values())
+                c = 1
+                while run_dir in taken:
+                    c += 1
+                    run_dir = os.path.join(session_dir,
+                                           "{0}_{1}".format(name, c))
+                self._run_dirs[key] = run_dir
+        return session_dir, run_dir
+
+    def _store(self, uid, d):
+        """Anonymize and write a single instance, which is recorded in the
+        manifest of its session before it replaces the output file (see
+        pseudicom._manifest)."""
+
+        tmp_file = None
+        try:
+            _anonymize(d, self.profile)
+            session_dir, run_dir = self._run_dir(d)
+            os.makedirs(run_dir, exist_ok=True)
+            out_file = os.path.join(
+                run_dir, _safe_name(d.get("SOPInstanceUID"), "instance") +
+                ".dcm")
+            tmp_file = out_file + ".tmp_anonym"
+            d.preamble = b"\x00" * 128
+            contents_hash = new_hash()
+            save_dataset(d, tmp_file, contents_hash)
+            manifest = Manifest(session_dir)
+            manifest.append([manifest.record(
+                out_file, from_file=tmp_file,
+                contents_hash=contents_hash.hexdigest(),
+                settings=self.profile.fingerprint, stage="anonymized",
+                deface_settings=None)])
+            os.replace(tmp_file, out_file)
+            return uid, session_dir, run_dir, out_file, None, _SUCCESS
+        except Exception as e:
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            status = _OUT_OF_RESOURCES if isinstance(e, OSError) \
+                else _CANNOT_UNDERSTAND
+            return uid, None, None, None, "{0}: {1}".format(
+                d.get("SOPInstanceUID", "?"), e), status
+
+    def _stored(self, future):
+        """Account for a stored instance (callback of _store)."""
+
+        uid, session_dir, run_dir, out_file, error, _ = future.result()
+        self._slots.release()
+        with self._lock:
+            series = self._series[uid]
+            series.pending -= 1
+            self._counts["queue_depth"] -= 1
+            if error is None:
+                series.files.append(out_file)
+                series.session_dir = session_dir
+                series.run_dir = run_dir
+                self._counts["stored"] += 1
+                self._last_stored = time.monotonic()
+            else:
+                series.errors += 1
+                self._counts["failed"] += 1
+        if error is not None:
+            _logger.error("Could not store %s", error)
+
+    def _complete_series(self, timeout):
+        """Hand on the series that are complete."""
+
+        now = time.monotonic()
+        with self._lock:
+            complete = [uid for uid, series in self._series.items()
+                        if series.pending == 0 and
+                        now - series.last_arrival >= timeout]
+            complete = [(uid, self._series.pop(uid)) for uid in complete]
+            self._counts["series_completed"] += len(complete)
+        for uid, series in complete:
+            if not series.files:
+                continue
+            anatomical = False
+            if self.deface:
+                d = pydicom.dcmread(series.files[0], stop_before_pixels=True)
+                anatomical = classify_series(d, len(series.files))[
+                    "anatomical"]
+                if anatomical:  # check that it is a single volume
+                    others = [pydicom.dcmread(f, stop_before_pixels=True)
+                              for f in series.files[1:]]
+                    anatomical = classify_series(d, len(series.files),
+                                                 others)["anatomical"]
+            _logger.info("Series %s complete (%d instances%s)",
+                         series.run_dir, len(series.files),
+                         ", anatomical" if anatomical else "")
+            if anatomical:
+                self._deface_queue.put(series)
+            elif self.forward is not None:
+                self._forward_queue.put(series)
+
+    def _monitor_loop(self):
+        last_report = time.monotonic()
+        while not self._stopping.wait(1.0):
+            self._complete_series(self.series_timeout)
+            if time.monotonic() - last_report >= self.report_interval:
+                last_report = time.monotonic()
+                _logger.info("Status: %s", self.stats())
+
+    def _deface_loop(self):
+        for series in iter(self._deface_queue.get, _STOP):
+            name = os.path.basename(series.run_dir)
+            try:
+                report = pseudonimize_dicoms(
+                    [series.session_dir],
+                    run_dir_pattern="^{0}$".format(re.escape(name)),
+                    anatomy_keywords=None, **self._deface_options)
+                status = report[series.session_dir]
+            except Exception as e:
+                status = {"succeeded": False, "failed_nodes": [],
+                          "errors": [str(e)]}
+            with self._lock:
+                if status["succeeded"]:
+                    self._counts["series_defaced"] += 1
+                else:
+                    self._counts["deface_failures"] += 1
+            if not status["succeeded"]:
+                _logger.error("Could not deface %s: %s", series.run_dir,
+                              status["failed_nodes"] or status["errors"])
+            elif self.forward is not None:
+                self._forward_queue.put(series)
+
+    def _forward_loop(self):
+        address, port, ae_title = self.forward or (None, None, None)
+        for series in iter(self._forward_queue.get, _STOP):
+            ae = AE(ae_title=self.ae_title)
+            ae.requested_contexts = StoragePresentationContexts
+            assoc = ae.associate(address, port, ae_title=ae_title)
+            n_forwarded = 0
+            if assoc.is_established:
+                for f in series.files:
+                    try:
+                        status = assoc.send_c_store(f)
+                    except Exception as e:
+                        _logger.error("Could not forward %s: %s", f, e)
+                        continue
+                    if status and status.Status == _SUCCESS:
+                        n_forwarded += 1
+                assoc.release()
+            else:
+                _logger.error("Could not associate with %s:%d", address,
+                              port)
+            with self._lock:
+                self._counts["forwarded"] += n_forwarded
+                self._counts["forward_failures"] += \
+                    len(series.files) - n_forwarded
+
+
+def _parse_forward(value):
+    address, port, ae_title = value.rsplit(":", 2)
+    return address, int(port), ae_title
+
+
+def main(argv=None):
+    """Run the DICOM receiver from the command line."""
+
+    parser = argparse.ArgumentParser(
+        prog="pseudicom-receive",
+        description="Receive DICOM instances (C-STORE), anonymize them on "
+                    "arrival and deface anatomical series.")
+    parser.add_argument("output_dir",
+                        help="the directory to write the instances to")
+    parser.add_argument("--port", type=int, default=11112)
+    parser.add_argument("--ae-title", default="PSEUDICOM")
+    parser.add_argument("--address", default="",
+                        help="the address to listen on (default: all)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="the number of instances to anonymize in "
+                             "parallel")
+    parser.add_argument("--series-timeout", type=float, default=30.0,
+                        help="the seconds after which a series without "
+                             "new instances is complete")
+    parser.add_argument("--no-deface", action="store_true",
+                        help="do not deface anatomical series")
+    parser.add_argument("--defacer", default="bet",
+                        help="see pseudonimize_dicoms")
+    parser.add_argument("--converter", default="dcm2niix",
+                        help="see pseudonimize_dicoms")
+    parser.add_argument("--work-dir", default=None,
+                        help="the Nipype working directory for defacing")
+    parser.add_argument("--forward", type=_parse_forward, default=None,
+                        metavar="ADDRESS:PORT:AE_TITLE",
+                        help="forward complete series to this Storage SCP")
+    parser.add_argument("--report-interval", type=float, default=60.0,
+                        help="the seconds between status reports")
+    parser.add_argument("--pseudonym-key-file", default=None,
+                        help="a file with the secret key for consistent "
+                             "pseudonyms of UIDs and dates (shifted per "
+                             "subject)")
+    parser.add_argument("--pseudonym-cache", default=None,
+                        help="the SQLite file to record the pseudonyms in")
+    parser.add_argument("--pseudonymize-patient-id", action="store_true",
+                        help="replace PatientIDs with their pseudonyms")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    pseudonyms = None
+    if args.pseudonym_key_file is not None:
+        with open(args.pseudonym_key_file, "rb") as f:
+            key = f.read().strip()
+        pseudonyms = PseudonymMap(key, args.pseudonym_cache,
+                                  patient_ids=args.pseudonymize_patient_id)
+    receiver = DicomReceiver(
+        args.output_dir, port=args.port, ae_title=args.ae_title,
+        address=args.address, n_workers=args.workers,
+        series_timeout=args.series_timeout, deface=not args.no_deface,
+        deface_options={"defacer": args.defacer,
+                        "converter": args.converter,
+                        "work_dir": args.work_dir},
+        forward=args.forward, report_interval=args.report_interval,
+        pseudonyms=pseudonyms)
+    receiver.serve_forever()
@@ -0,0 +1,109 @@
+"""Scanning of session directories.
+
+"""
+
+
+import os
+import re
+import functools
+import collections
+
+from ._manifest import MANIFEST_DIR
+
+
+FileEntry = collections.namedtuple("FileEntry", ["path", "size", "mtime_ns"])
+
+SessionIndex = collections.namedtuple("SessionIndex", ["runs", "other_files"])
+
+_DICOM_EXTENSIONS = (".dcm", ".IMA")
+
+# Files left behind by (earlier) processing
+_PROCESSING_SUFFIXES = (".bak_anonym", ".bak_deface", ".tmp_anonym",
+                        ".tmp_deface", ".tmp_pseudicom")
+
+_PREAMBLE_SIZE = 128
+
+
+@functools.lru_cache()
+def _compile(pattern):
+    return re.compile(pattern)
+
+
+def _has_dicom_preamble(path):
+    """Check whether a file starts with a DICOM preamble and prefix."""
+
+    try:
+        with open(path, "rb") as f:
+            f.seek(_PREAMBLE_SIZE)
+            return f.read(4) == b"DICM"
+    except OSError:
+        return False
+
+
+def is_dicom(name, path):
+    """Check whether a file is a DICOM file.
+
+    Files are recognized by their extension (".dcm" or ".IMA"), or, if they
+    do not have an extension, by their preamble.
+
+    """
+
+    if name.endswith(_DICOM_EXTENSIONS):
+        return True
+    if "." in name:
+        return False
+    return _has_dicom_preamble(path)
+
+
+def scan_session(directory, run_dir_pattern):
+    """Scan a session directory in a single pass.
+
+    Parameters
+    ----------
+    directory : str
+        the session directory
+    run_dir_pattern : str
+        a regular expression that specifies the pattern to find run
+        directories (matched against the names of all directories within
+        the session directory)
+
+    Returns
+    -------
+    index : SessionIndex
+        the index of the session, with "runs" mapping each run directory
+        (sorted) that contains DICOM files to its DICOM files (FileEntry,
+        sorted by path), and "other_files" listing all files that are
+        neither DICOM files nor left behind by processing (excluding the
+        manifest directory)
+
+    """
+
+    pattern = _compile(run_dir_pattern)
+    runs = {}
+    other_files = []
+    stack = [(directory, False)]
+    while stack:
+        path, is_run = stack.pop()
+        dicoms = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if path == directory and entry.name == MANIFEST_DIR:
+                        continue
+                    is_run_dir = pattern.search(entry.name) is not None
+                    if is_run_dir or not entry.is_symlink():
+                        stack.append((entry.path, is_run_dir))
+                    continue
+                if entry.name.endswith(_PROCESSING_SUFFIXES):
+                    continue
+                st = entry.stat()
+                file_entry = FileEntry(entry.path, st.st_size,
+                                       st.st_mtime_ns)
+                if is_dicom(entry.name, entry.path):
+                    if is_run:
+                        dicoms.append(file_entry)
+                else:
+                    other_files.append(file_entry)
+        if dicoms:
+            runs[path] = sorted(dicoms)
+    return SessionIndex(dict(sorted(runs.items())), sorted(other_files))
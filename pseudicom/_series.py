@@ -0,0 +1,187 @@
+"""Classification of the series (run directories) of a session.
+
+"""
+
+
+import os
+import json
+
+import pydicom
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
+
+from ._manifest import MANIFEST_DIR
+from ._volume import is_multiframe, pixel_measures, slice_positions
+
+
+SERIES_FILE = "series.json"
+
+# Smallest number of slices and largest voxel size (in mm) of an anatomical
+# series that needs to be defaced
+_ANAT_MIN_SLICES = 64
+_ANAT_MAX_VOXEL_SIZE = 2.0
+
+# Version of the classification, which invalidates the index entries of
+# former versions
+_INDEX_VERSION = 2
+
+
+def _single_volume(d, others):
+    """Check whether the slices of a series form a single volume (i.e. are
+    not several echoes or time points)."""
+
+    if int(d.get("NumberOfTemporalPositions") or 1) > 1:
+        return False
+    echoes = d.get("EchoNumbers")
+    if isinstance(echoes, MultiValue) and len(echoes) > 1:
+        return False
+    if others is None:
+        return True
+    positions = [p for h in [d] + list(others) for p in slice_positions(h)]
+    return None in positions or len(set(positions)) == len(positions)
+
+
+def classify_series(d, n_slices, others=None):
+    """Describe a series by one of its headers.
+
+    A series is considered anatomical (and needs to be defaced) if it is
+    a 3D acquisition of a single volume (i.e. not of several echoes or time
+    points) with at least 64 slices and a voxel size of at most 2 mm, and
+    is not derived from another series.
+
+    Parameters
+    ----------
+    d : pydicom.dataset.Dataset
+        a representative header of the series
+    n_slices : int
+        the number of files of the series (which is multiplied by the number
+        of frames, for multi-frame files)
+    others : list, optional
+        the headers of the other files of the series; if given, a series of
+        which several slices share the same position is not a single volume
+        (which can otherwise only be told by the NumberOfTemporalPositions
+        and EchoNumbers of d)
+
+    Returns
+    -------
+    info : dict
+        the description ("description", "image_type", "acquisition",
+        "n_slices", "voxel_size") and classification ("single_volume",
+        "anatomical") of the series
+
+    """
+
+    image_type = [str(x) for x in d.get("ImageType") or []]
+    frame = None
+    if is_multiframe(d):
+        n_slices *= int(d.NumberOfFrames)
+        frame = 0
+    single_volume = _single_volume(d, others)
+    spacing, thickness = pixel_measures(d, frame)
+    voxel_size = spacing or []
+    if voxel_size and thickness is not None:
+        voxel_size.append(thickness)
+    acquisition = str(d.get("MRAcquisitionType") or "")
+    anatomical = acquisition == "3D" and single_volume and \
+        "DERIVED" not in image_type and \
+        n_slices >= _ANAT_MIN_SLICES and \
+        len(voxel_size) == 3 and max(voxel_size) <= _ANAT_MAX_VOXEL_SIZE
+    return {"description": str(d.get("SeriesDescription") or ""),
+            "image_type": image_type,
+            "acquisition": acquisition,
+            "n_slices": n_slices,
+            "voxel_size": voxel_size,
+            "single_volume": single_volume,
+            "anatomical": anatomical}
+
+
+class SeriesIndex:
+    """The cached classification of the series of a session.
+
+    The index is a JSON file next to the manifest of the session, and holds
+    the description of each run directory, together with the representative
+    file it was read from.
+
+    Parameters
+    ----------
+    session_dir : str
+        the (output) session directory holding the index
+    source_dir : str, optional
+        the session directory containing the run directories, if different
+
+    """
+
+    def __init__(self, session_dir, source_dir=None):
+        self.source_dir = source_dir or session_dir
+        self.path = os.path.join(session_dir, MANIFEST_DIR, SERIES_FILE)
+        self._series = {}
+        self._changed = False
+
+    def load(self):
+        """Load the index (if it exists)."""
+
+        try:
+            with open(self.path) as f:
+                self._series = json.load(f)
+        except (OSError, ValueError):
+            self._series = {}
+        self._changed = False
+
+    def save(self):
+        """Save the index (if it has changed)."""
+
+        if not self._changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_file = self.path + ".tmp_pseudicom"
+        with open(tmp_file, "w") as f:
+            json.dump(self._series, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.path)
+        self._changed = False
+
+    def describe(self, run_dir, dicoms):
+        """Get the description of a run directory.
+
+        The description is only read from the first DICOM file (without its
+        pixel data) if it is not in the index yet, or if the run directory
+        has changed since. The headers of the other files are only read if
+        the first one describes an anatomical series, to check that its
+        slices form a single volume.
+
+        Parameters
+        ----------
+        run_dir : str
+            the run directory
+        dicoms : list
+            the (sorted) DICOM files (pseudicom._scan.FileEntry) of the run
+            directory
+
+        Returns
+        -------
+        info : dict
+            the description of the series (see classify_series)
+
+        """
+
+        key = os.path.relpath(run_dir, self.source_dir)
+        stamp = {"file": os.path.basename(dicoms[0].path),
+                 "size": dicoms[0].size,
+                 "mtime_ns": dicoms[0].mtime_ns,
+                 "n_files": len(dicoms),
+                 "version": _INDEX_VERSION}
+        entry = self._series.get(key)
+        if entry is None or entry["stamp"] != stamp:
+            try:
+                d = pydicom.dcmread(dicoms[0].path, stop_before_pixels=True)
+            except InvalidDicomError:
+                d = Dataset()
+            info = classify_series(d, len(dicoms))
+            if info["anatomical"]:
+                others = [pydicom.dcmread(f.path, stop_before_pixels=True)
+                          for f in dicoms[1:]]
+                info = classify_series(d, len(dicoms), others)
+            entry = {"stamp": stamp, "info": info}
+            self._series[key] = entry
+            self._changed = True
+        return entry["info"]
@@ -0,0 +1,347 @@
+"""Assembly of DICOM slices (or frames) into volumes, and back.
+
+"""
+
+
+import numpy as np
+import pydicom
+from pydicom.uid import ExplicitVRLittleEndian
+
+from ._files import save_dataset
+from ._encoding import can_encode, encode
+
+
+# Converts LPS (DICOM) into RAS (NIfTI) coordinates
+_LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def _is_derived(d):
+    image_type = d.get("ImageType")
+    return image_type is not None and "DERIVED" in image_type
+
+
+def is_multiframe(d):
+    """Check whether a dataset holds several frames."""
+
+    return int(d.get("NumberOfFrames") or 1) > 1
+
+
+def _functional_group(d, frame, sequence):
+    """Get the item of a functional group sequence for a frame of an
+    (enhanced) multi-frame dataset, from the per-frame or else the shared
+    functional groups."""
+
+    per_frame = d.get("PerFrameFunctionalGroupsSequence")
+    shared = d.get("SharedFunctionalGroupsSequence")
+    for group in (per_frame[frame] if per_frame else None,
+                  shared[0] if shared else None):
+        if group is not None and group.get(sequence):
+            return group.get(sequence)[0]
+    return None
+
+
+def _rescale(d):
+    """Get the (slope, intercept) of the stored values of a dataset."""
+
+    return (float(d.get("RescaleSlope", 1.0)),
+            float(d.get("RescaleIntercept", 0.0)))
+
+
+def slice_rescale(d, frame=None):
+    """Get the (slope, intercept) of the stored values of a slice.
+
+    Parameters
+    ----------
+    d : pydicom.dataset.Dataset
+        the dataset
+    frame : int, optional
+        the frame, if the dataset is a multi-frame dataset
+
+    Returns
+    -------
+    rescale : tuple
+        the slope and intercept
+
+    """
+
+    if frame is not None:
+        item = _functional_group(d, frame, "PixelValueTransformationSequence")
+        if item is not None:
+            return _rescale(item)
+    return _rescale(d)
+
+
+def pixel_measures(d, frame=None):
+    """Get the (PixelSpacing, SliceThickness) of a slice.
+
+    Parameters
+    ----------
+    d : pydicom.dataset.Dataset
+        the dataset
+    frame : int, optional
+        the frame, if the dataset is a multi-frame dataset
+
+    Returns
+    -------
+    pixel_spacing : list or None
+        the row and column spacing (in mm)
+    slice_thickness : float or None
+        the slice thickness (in mm)
+
+    """
+
+    if frame is not None:
+        d = _functional_group(d, frame, "PixelMeasuresSequence") or d
+    spacing = d.get("PixelSpacing")
+    thickness = d.get("SliceThickness")
+    return ([float(x) for x in spacing] if spacing else None,
+            float(thickness) if thickness not in (None, "") else None)
+
+
+def _geometry(d, frame):
+    """Get the (ImagePositionPatient, ImageOrientationPatient, PixelSpacing)
+    of a slice (any of which is None if missing)."""
+
+    position = d.get("ImagePositionPatient")
+    orientation = d.get("ImageOrientationPatient")
+    if frame is not None:
+        item = _functional_group(d, frame, "PlanePositionSequence")
+        if item is not None:
+            position = item.get("ImagePositionPatient")
+        item = _functional_group(d, frame, "PlaneOrientationSequence")
+        if item is not None:
+            orientation = item.get("ImageOrientationPatient")
+    spacing, thickness = pixel_measures(d, frame)
+    return (np.array([float(x) for x in position]) if position else None,
+            np.array([float(x) for x in orientation]) if orientation
+            else None,
+            spacing)
+
+
+def slice_positions(d):
+    """Get the ImagePositionPatient of each slice of a dataset (i.e. of each
+    frame of a multi-frame dataset), rounded to micrometers (None if
+    missing)."""
+
+    frames = range(int(d.NumberOfFrames)) if is_multiframe(d) else [None]
+    positions = []
+    for frame in frames:
+        position = _geometry(d, frame)[0]
+        positions.append(tuple(np.round(position, 3))
+                         if position is not None else None)
+    return positions
+
+
+def pixel_dtype(d):
+    """Get the data type of the stored pixel values of a dataset.
+
+    Parameters
+    ----------
+    d : pydicom.dataset.Dataset
+        the dataset (possibly read without pixel data)
+
+    Returns
+    -------
+    dtype : numpy.dtype
+        the data type (in the byte order of the dataset)
+
+    """
+
+    bits = d.BitsAllocated
+    if bits not in (8, 16, 32):
+        raise ValueError("Unsupported BitsAllocated: {0}".format(bits))
+    try:
+        is_little_endian = d.original_encoding[1]
+    except AttributeError:  # pydicom<3
+        is_little_endian = d.is_little_endian
+    return np.dtype("{0}{1}{2}".format(
+        "<" if is_little_endian in (True, None) else ">",
+        "i" if d.PixelRepresentation == 1 else "u", bits // 8))
+
+
+def to_stored_values(values, d, rescale=None):
+    """Convert pixel values into the stored values of a dataset.
+
+    The rescale slope and intercept are reverted, and the values are rounded
+    and clipped to the range of BitsStored.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        the (real world) pixel values
+    d : pydicom.dataset.Dataset
+        the dataset (possibly read without pixel data)
+    rescale : tuple, optional
+        the (slope, intercept) of the slice (see slice_rescale), if different
+        from that of the dataset
+
+    Returns
+    -------
+    stored : numpy.ndarray
+        the stored values, in the pixel data type of the dataset (see
+        pixel_dtype)
+
+    """
+
+    dtype = pixel_dtype(d)
+    slope, intercept = rescale or _rescale(d)
+    if (slope, intercept) != (1.0, 0.0):
+        values = (values - intercept) / slope
+    if values.dtype.kind == "f":
+        values = np.rint(values)
+    bits = d.get("BitsStored", d.BitsAllocated)
+    if dtype.kind == "i":
+        low, high = -2 ** (bits - 1), 2 ** (bits - 1) - 1
+    else:
+        low, high = 0, 2 ** bits - 1
+    return np.clip(values, low, high).astype(dtype)
+
+
+def save_pixels(d, out_file, pixels, contents_hash=None):
+    """Atomically save a dataset with new pixel data.
+
+    The pixel data is encoded with the transfer syntax of the dataset, or
+    saved uncompressed if that cannot be encoded (see
+    pseudicom._encoding.can_encode).
+
+    Parameters
+    ----------
+    d : pydicom.dataset.Dataset
+        the dataset (possibly read without pixel data)
+    out_file : str
+        the file to write
+    pixels : numpy.ndarray
+        the stored values (of all frames), in the pixel data type of the
+        dataset (see pixel_dtype)
+    contents_hash : hash object, optional
+        if given, updated with the contents of the file (see save_dataset)
+
+    """
+
+    transfer_syntax = d.file_meta.TransferSyntaxUID
+    if not can_encode(transfer_syntax):
+        transfer_syntax = ExplicitVRLittleEndian
+    encode(d, transfer_syntax, pixels)
+    save_dataset(d, out_file, contents_hash)
+
+
+def build_volume(datasets):
+    """Assemble the slices of a single series into a volume.
+
+    The slices are either single-frame datasets, or the frames of (enhanced)
+    multi-frame datasets, and are ordered by their position (from the
+    per-frame functional groups, for frames).
+
+    The volume holds the stored pixel values (in their original data type),
+    with data[:, :, k].T being the pixel array of the k-th slice along the
+    slice normal. If the slices have different rescale slopes or intercepts,
+    the volume holds the rescaled values instead.
+
+    Parameters
+    ----------
+    datasets : list
+        the datasets (pydicom.dataset.Dataset) of the slices, in any order
+
+    Returns
+    -------
+    data : numpy.ndarray
+        the 3D volume
+    affine : numpy.ndarray
+        the 4x4 affine from voxel to (NIfTI) RAS coordinates
+    order : list
+        the (index within datasets, frame) of each slice of the volume, with
+        frame being None for single-frame datasets
+    scaling : tuple
+        the (slope, intercept) to get from the values of the volume to real
+        world values
+
+    Raises
+    ------
+    ValueError
+        if the datasets do not form a 3D stack of (non-derived) slices
+
+    """
+
+    slices = []
+    for c, d in enumerate(datasets):
+        if _is_derived(d):
+            raise ValueError("Derived series")
+        if is_multiframe(d):
+            slices.extend((c, i) for i in range(int(d.NumberOfFrames)))
+        else:
+            slices.append((c, None))
+    if len(slices) < 2:
+        raise ValueError("Not a 3D series (single slice)")
+    geometry = [_geometry(datasets[c], i) for c, i in slices]
+    first = datasets[0]
+    position, orientation, spacing = geometry[0]
+    for (c, i), (p, o, s) in zip(slices, geometry):
+        if p is None or o is None or s is None:
+            raise ValueError("Missing geometry")
+        d = datasets[c]
+        if (d.Rows, d.Columns) != (first.Rows, first.Columns) or \
+                not np.allclose(o, orientation, atol=1e-4):
+            raise ValueError("Slices of different size or orientation")
+    row_cosine, col_cosine = orientation[:3], orientation[3:]
+    normal = np.cross(row_cosine, col_cosine)
+    positions = np.array([p for p, o, s in geometry])
+    distances = positions @ normal
+    order = [int(c) for c in np.argsort(distances, kind="stable")]
+    if np.any(np.diff(distances[order]) < 1e-4):
+        raise ValueError("Several slices at the same position")
+
+    pixel_arrays = {}
+
+    def pixels(c, i):
+        if c not in pixel_arrays:
+            pixel_arrays[c] = datasets[c].pixel_array
+        return pixel_arrays[c] if i is None else pixel_arrays[c][i]
+
+    data = np.stack([pixels(*slices[k]).T for k in order], axis=2)
+    rescales = [slice_rescale(datasets[c], i) for c, i in slices]
+    scaling = rescales[0]
+    if any(rescale != scaling for rescale in rescales):
+        data = data.astype(np.float32)
+        for k, c in enumerate(order):
+            slope, intercept = rescales[c]
+            data[:, :, k] = data[:, :, k] * slope + intercept
+        scaling = (1.0, 0.0)
+    row_spacing, col_spacing = spacing
+    step = (positions[order[-1]] - positions[order[0]]) / (len(order) - 1)
+    affine = np.eye(4)
+    affine[:3, 0] = row_cosine * col_spacing
+    affine[:3, 1] = col_cosine * row_spacing
+    affine[:3, 2] = step
+    affine[:3, 3] = positions[order[0]]
+    return data, _LPS_TO_RAS @ affine, [slices[k] for k in order], scaling
+
+
+def load_series(in_files):
+    """Read the DICOM files of a single series and assemble them into a
+    volume.
+
+    Parameters
+    ----------
+    in_files : list
+        the DICOM files of the series
+
+    Returns
+    -------
+    data, affine
+        see build_volume
+    slices : list
+        the (file, frame) of each slice of the volume, with frame being None
+        for single-frame files
+    scaling
+        see build_volume
+
+    Raises
+    ------
+    ValueError
+        see build_volume
+
+    """
+
+    datasets = [pydicom.dcmread(f) for f in in_files]
+    data, affine, order, scaling = build_volume(datasets)
+    return data, affine, [(in_files[c], i) for c, i in order], scaling
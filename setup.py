@@ -21,4 +21,11 @@ setup(
     packages = ['pseudicom'],
     install_requires = ['nipype',
                         'pydicom',
-                        'quickshear'])
+                        'quickshear',
+                        'scipy'],
+    extras_require = {'receiver': ['pynetdicom'],
+                      'compression': ['pyjpegls',
+                                      'pylibjpeg',
+                                      'pylibjpeg-openjpeg']},
+    entry_points = {'console_scripts': [
+        'pseudicom-receive = pseudicom._receiver:main']})